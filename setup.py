@@ -37,6 +37,8 @@ setup(
         read('src/zc/relation/tokens.rst'),
         read('src/zc/relation/searchindex.rst'),
         read('src/zc/relation/optimization.rst'),
+        read('src/zc/relation/bitmap.rst'),
+        read('src/zc/relation/transient.rst'),
         read('CHANGES.rst'),
     ]),
     classifiers=[
@@ -56,6 +58,7 @@ setup(
         'BTrees',
         'zope.interface',
         'setuptools',
+        'transaction',
         'zope.testing',
     ],
     extras_require={'test': [
@@ -0,0 +1,431 @@
+##############################################################################
+#
+# Copyright (c) 2006-2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compressed bitmap sets of integer tokens.
+
+This module can be the ``btree`` of a catalog, or of a value index, in place
+of a BTrees module.  It has the Set, TreeSet, union, intersection, difference
+and multiunion that the catalog uses.  The sets do not resolve conflicts.
+See bitmap.rst.
+"""
+import array
+import bisect
+import itertools
+
+import persistent
+
+
+ARRAY_LIMIT = 4096  # containers with more tokens are bitmaps
+CHUNK_SIZE = 64  # TreeSet containers with more tokens are records of their own
+MAXKEY = 2 ** 63 - 1
+_BITMAP_BYTES = 8192  # 65536 bits
+
+_BINARY = bytes.maketrans(b'01', b'\x00\x01')
+
+try:
+    _count = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _count(bitmap):
+        return bin(bitmap).count('1')
+
+
+##############################################################################
+# containers
+#
+# A container has the tokens that share their high bits (token >> 16).  It
+# is an array of the sorted low 16 bits of the tokens, or, when it has more
+# than ARRAY_LIMIT tokens, an int with a bit for each of them.  Containers
+# are never changed in place.
+
+def _split(key):
+    if not isinstance(key, int):
+        raise TypeError('expected integer key', key)
+    if not 0 <= key <= MAXKEY:
+        raise TypeError('integer out of range', key)
+    return key >> 16, key & 0xFFFF
+
+
+def _isBitmap(container):
+    return isinstance(container, int)
+
+
+def _len(container):
+    if _isBitmap(container):
+        return _count(container)
+    return len(container)
+
+
+def _contains(container, low):
+    if _isBitmap(container):
+        return container >> low & 1
+    i = bisect.bisect_left(container, low)
+    return i < len(container) and container[i] == low
+
+
+def _lows(container):
+    if not _isBitmap(container):
+        return container
+    # "0b1101" -> b"\x01\x00\x01\x01" selects 0, 2 and 3 from the range
+    bits = bin(container)[:1:-1].encode('ascii').translate(_BINARY)
+    return list(itertools.compress(range(len(bits)), bits))
+
+
+def _toBitmap(container):
+    if _isBitmap(container):
+        return container
+    bits = bytearray(_BITMAP_BYTES)
+    for low in container:
+        bits[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def _fromLows(lows):
+    # a container of unsorted, possibly repeated, lows
+    lows = sorted(set(lows))
+    if len(lows) > ARRAY_LIMIT:
+        return _toBitmap(lows)
+    return array.array('H', lows)
+
+
+def _fromBitmap(bitmap):
+    if _count(bitmap) > ARRAY_LIMIT:
+        return bitmap
+    return array.array('H', _lows(bitmap))
+
+
+def _union(c1, c2):
+    if not _isBitmap(c1) and not _isBitmap(c2):
+        return _fromLows(set(c1).union(c2))
+    return _toBitmap(c1) | _toBitmap(c2)
+
+
+def _intersection(c1, c2):
+    if _isBitmap(c1) and _isBitmap(c2):
+        return _fromBitmap(c1 & c2)
+    if _isBitmap(c1):
+        c1, c2 = c2, c1
+    if _isBitmap(c2):
+        return array.array('H', [low for low in c1 if c2 >> low & 1])
+    return array.array('H', sorted(set(c1).intersection(c2)))
+
+
+def _difference(c1, c2):
+    if _isBitmap(c1):
+        return _fromBitmap(c1 & ~_toBitmap(c2))
+    if _isBitmap(c2):
+        return array.array('H', [low for low in c1 if not c2 >> low & 1])
+    return array.array('H', sorted(set(c1).difference(c2)))
+
+
+def _multiunion(containers):
+    if sum(_len(c) for c in containers) <= ARRAY_LIMIT:
+        return _fromLows(
+            [low for c in containers for low in _lows(c)])
+    res = 0
+    for c in containers:
+        res |= _toBitmap(c)
+    return _fromBitmap(res)
+
+
+def _group(keys):
+    # high: [lows]
+    res = {}
+    for key in keys:
+        high, low = _split(key)
+        lows = res.get(high)
+        if lows is None:
+            lows = res[high] = []
+        lows.append(low)
+    return res
+
+
+##############################################################################
+# sets
+#
+
+class Chunk(persistent.Persistent):
+    """a container of a TreeSet, kept in a database record of its own."""
+
+    def __init__(self, container):
+        self.container = container
+
+
+class _BitmapSet(persistent.Persistent):
+    # the containers of a Set are in its own record.  The containers of a
+    # TreeSet that have more than _chunkSize tokens are Chunks.  Unlike the
+    # BTrees sets, the sets have no _p_resolveConflict: concurrent changes to
+    # the same record conflict.
+    _chunkSize = None
+    keyType = 'L'  # 64 bit integers, for zc.relation.catalog.getKeyType
+
+    def __init__(self, items=None):
+        self._highs = []
+        self._containers = []
+        if items:
+            self.update(items)
+
+    def _get(self, i):
+        container = self._containers[i]
+        if isinstance(container, Chunk):
+            return container.container
+        return container
+
+    def _put(self, i, container):
+        # set the non-empty container of the high at i
+        old = self._containers[i]
+        if self._chunkSize is not None and _len(container) > self._chunkSize:
+            if isinstance(old, Chunk):
+                old.container = container
+                return
+            container = Chunk(container)
+        self._containers[i] = container
+        self._p_changed = True
+
+    def _find(self, high):
+        # the index of the container of high, or None
+        i = bisect.bisect_left(self._highs, high)
+        if i < len(self._highs) and self._highs[i] == high:
+            return i
+        return None
+
+    def _items(self):
+        # (high, container) pairs, in order
+        return [(high, self._get(i)) for i, high in enumerate(self._highs)]
+
+    def _setItems(self, items):
+        self._highs = []
+        self._containers = []
+        for high, container in items:
+            if _len(container):
+                self._highs.append(high)
+                self._containers.append(None)
+                self._put(len(self._highs) - 1, container)
+
+    def __len__(self):
+        return sum(_len(self._get(i)) for i in range(len(self._highs)))
+
+    def __bool__(self):
+        return bool(self._highs)
+
+    def __contains__(self, key):
+        try:
+            high, low = _split(key)
+        except TypeError:
+            return False
+        i = self._find(high)
+        return i is not None and bool(_contains(self._get(i), low))
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        for high, container in self._items():
+            base = high << 16
+            if max is not None and base > max:
+                break
+            if min is not None and base + 0xFFFF < min:
+                continue
+            if (min is None or base > min) and (
+                    max is None or base + 0xFFFF < max):
+                yield from map(base.__add__, _lows(container))
+                continue
+            for low in _lows(container):
+                key = base + low
+                if min is not None and (
+                        key < min or excludemin and key == min):
+                    continue
+                if max is not None and (
+                        key > max or excludemax and key == max):
+                    return
+                yield key
+
+    def minKey(self, min=None):
+        for key in self.keys(min=min):
+            return key
+        raise ValueError('empty tree' if min is None else 'no key satisfies'
+                         ' the conditions')
+
+    def maxKey(self, max=None):
+        for i in range(len(self._highs) - 1, -1, -1):
+            base = self._highs[i] << 16
+            if max is not None and base > max:
+                continue
+            for low in reversed(_lows(self._get(i))):
+                if max is None or base + low <= max:
+                    return base + low
+        raise ValueError('empty tree' if max is None else 'no key satisfies'
+                         ' the conditions')
+
+    def insert(self, key):
+        high, low = _split(key)
+        i = self._find(high)
+        if i is None:
+            i = bisect.bisect_left(self._highs, high)
+            self._highs.insert(i, high)
+            self._containers.insert(i, None)
+            self._put(i, array.array('H', (low,)))
+            return 1
+        container = self._get(i)
+        if _contains(container, low):
+            return 0
+        if _isBitmap(container):
+            container |= 1 << low
+        else:
+            container = array.array('H', container)
+            bisect.insort(container, low)
+            if len(container) > ARRAY_LIMIT:
+                container = _toBitmap(container)
+        self._put(i, container)
+        return 1
+
+    add = insert
+
+    def remove(self, key):
+        high, low = _split(key)
+        i = self._find(high)
+        if i is None or not _contains(self._get(i), low):
+            raise KeyError(key)
+        container = self._get(i)
+        if _isBitmap(container):
+            container = _fromBitmap(container & ~(1 << low))
+        else:
+            container = array.array('H', container)
+            container.remove(low)
+        if container:
+            self._put(i, container)
+        else:
+            del self._highs[i]
+            del self._containers[i]
+            self._p_changed = True
+
+    def update(self, items):
+        if isinstance(items, _BitmapSet):
+            groups = items._items()
+        else:
+            groups = [(high, _fromLows(lows))
+                      for high, lows in _group(items).items()]
+        added = 0
+        for high, container in groups:
+            i = self._find(high)
+            if i is None:
+                i = bisect.bisect_left(self._highs, high)
+                self._highs.insert(i, high)
+                self._containers.insert(i, None)
+                self._put(i, container)
+                added += _len(container)
+            else:
+                old = self._get(i)
+                new = _union(old, container)
+                if _len(new) != _len(old):
+                    added += _len(new) - _len(old)
+                    self._put(i, new)
+        return added
+
+    def clear(self):
+        self._highs = []
+        self._containers = []
+
+    def __copy__(self):
+        res = self.__class__()
+        res._setItems(self._items())
+        return res
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+
+class LBitmapSet(_BitmapSet):
+    """a set of tokens that is one database record, like a BTrees Set."""
+
+
+class LBitmapTreeSet(_BitmapSet):
+    """a set of tokens that keeps its larger containers as Chunks."""
+
+    _chunkSize = CHUNK_SIZE
+
+    def __repr__(self):
+        return persistent.Persistent.__repr__(self)
+
+
+Set = LBitmapSet
+TreeSet = LBitmapTreeSet
+
+
+##############################################################################
+# set operations
+#
+# As the functions of BTrees modules, these return Sets; and None stands for
+# the universe of tokens.
+
+def _asItems(s):
+    if isinstance(s, _BitmapSet):
+        return s._items()
+    return sorted((high, _fromLows(lows))
+                  for high, lows in _group(s).items())
+
+
+def _result(items):
+    res = Set()
+    res._setItems(items)
+    return res
+
+
+def union(c1, c2):
+    if c1 is None:
+        return c2
+    if c2 is None:
+        return c1
+    res = dict(_asItems(c1))
+    for high, container in _asItems(c2):
+        other = res.get(high)
+        res[high] = container if other is None else _union(other, container)
+    return _result(sorted(res.items()))
+
+
+def intersection(c1, c2):
+    if c1 is None:
+        return c2
+    if c2 is None:
+        return c1
+    items1 = _asItems(c1)
+    items2 = dict(_asItems(c2))
+    return _result([
+        (high, _intersection(container, items2[high]))
+        for high, container in items1 if high in items2])
+
+
+def difference(c1, c2):
+    if c1 is None or c2 is None:
+        return c1
+    items2 = dict(_asItems(c2))
+    return _result([
+        (high, container if high not in items2 else
+         _difference(container, items2[high]))
+        for high, container in _asItems(c1)])
+
+
+def multiunion(seq):
+    containers = {}  # high: [containers]
+    keys = []
+    for s in seq:
+        if isinstance(s, int):
+            keys.append(s)
+            continue
+        for high, container in _asItems(s):
+            containers.setdefault(high, []).append(container)
+    for high, lows in _group(keys).items():
+        containers.setdefault(high, []).append(lows)
+    return _result(sorted(
+        (high, _multiunion(cs)) for high, cs in containers.items()))
@@ -11,8 +11,15 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
+import collections.abc
 import copy
+import functools
+import hashlib
+import inspect
 import sys
+import time
+import weakref
 
 import BTrees
 import BTrees.check
@@ -20,6 +27,7 @@ import BTrees.Length
 import persistent
 import persistent.list
 import persistent.wref
+import transaction
 import zope.interface
 import zope.interface.interfaces
 
@@ -56,6 +64,70 @@ def multiunion(sets, data):
     return res
 
 
+# about how many times longer it takes to find whether a set has a token
+# than to take a token through an intersection of sets.
+_PROBE_COST = 4
+
+
+def _probe(tokens, sets):
+    # the tokens that are in any of the sets
+    for token in tokens:
+        for s in sets:
+            if token in s:
+                yield token
+                break
+
+
+def _checkMaxDepth(maxDepth):
+    if maxDepth is not None and (
+            not isinstance(maxDepth, int) or maxDepth < 1):
+        raise ValueError('maxDepth must be None or a positive integer')
+
+
+def _checkMinDepth(minDepth):
+    if minDepth is not None and (
+            not isinstance(minDepth, int) or minDepth < 1):
+        raise ValueError('minDepth must be None or a positive integer')
+
+
+def _isPathIndependent(check):
+    return check is None or interfaces.IPathIndependentFilter.providedBy(check)
+
+
+def _isPathIndependentQueries(getQueries):
+    return getQueries is None or interfaces.IPathIndependentQueries.providedBy(
+        getQueries)
+
+
+# a search records how it is done in a report, a dict, when Catalog.explain
+# gives it one.  These help.
+
+def _report(report, key, value):
+    if report is not None:
+        report[key] = value
+
+
+def _steps(report, key):
+    # the list of the report that _relData should record its steps in
+    if report is not None:
+        return report[key]
+
+
+def _reportSearchIndex(report, key, ix, reason):
+    # record why a search index is, or is not, used
+    if report is not None:
+        if reason == 'used':
+            report['path'] = 'search index'
+        if (key, ix, reason) not in report['searchIndexes']:  # canFind
+            report['searchIndexes'].append((key, ix, reason))  # asks twice
+
+
+def _countChains(chains, report):
+    for chain in chains:
+        report['chains'] += 1
+        yield chain
+
+
 def getModuleTools(module):
     return {
         nm: getattr(module, nm, None) for nm in
@@ -63,17 +135,269 @@ def getModuleTools(module):
          'intersection', 'multiunion', 'union', 'difference')}
 
 
+def getKeyType(tools):
+    """the type of the tokens of the sets of the tools, as the letter that
+    BTrees uses for it: 'I' or 'L' for 32 or 64 bit integers, 'U' or 'Q' for
+    unsigned ones, 'O' for objects.
+
+    Sets that are not of a BTrees module say so with a ``keyType`` attribute.
+    The BTrees sets are named for their key type."""
+    TreeSet = tools['TreeSet']
+    res = getattr(TreeSet, 'keyType', None)
+    if res is None:
+        res = TreeSet.__name__[0]
+    return res
+
+
+def getFingerprintMapping(tools):
+    # relation tokens to 64 bit fingerprints
+    keyType = getKeyType(tools)
+    if keyType in 'IL':
+        Mapping = BTrees.family64.II.BTree
+    elif keyType in 'UQ':
+        Mapping = BTrees.family64.UI.BTree
+    else:
+        Mapping = BTrees.family64.OI.BTree
+    return Mapping
+
+
+def _encodeToken(token):
+    # bytes that are the same for equal tokens in every process
+    if isinstance(token, bool) or not isinstance(
+            token, (int, str, bytes, tuple)):
+        data = b'r' + repr(token).encode('utf-8', 'backslashreplace')
+    elif isinstance(token, int):
+        data = b'i%d' % token
+    elif isinstance(token, str):
+        data = b's' + token.encode('utf-8', 'surrogatepass')
+    elif isinstance(token, bytes):
+        data = b'b' + token
+    else:
+        data = b't' + b''.join(_encodeToken(t) for t in token)
+    return b'%d:%s' % (len(data), data)
+
+
+def fingerprint(tokenSets):
+    """a 64 bit digest of the token sets of a relation's value indexes.
+
+    The value indexes must be in the order of their names.  Empty sets, and
+    None, are no values.  The digest is a blake2b of the sorted tokens, so it
+    is the same in every process.  Tokens other than integers, strings,
+    bytes and tuples of them are digested by their repr."""
+    digest = hashlib.blake2b(digest_size=8)
+    for tokens in tokenSets:
+        if tokens:
+            tokens = sorted(set(tokens))
+            digest.update(b'%d:' % len(tokens))
+            for token in tokens:
+                digest.update(_encodeToken(token))
+        else:
+            digest.update(b'-')
+    return int.from_bytes(digest.digest(), 'little', signed=True)
+
+
+class Length:
+    """a counter like BTrees.Length.Length that is not persistent, for
+    catalogs that are not stored in a database."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, v=0):
+        self.value = v
+
+    def set(self, v):
+        self.value = v
+
+    def change(self, delta):
+        self.value += delta
+
+    def __call__(self, *args):
+        return self.value
+
+    def __copy__(self):
+        return Length(self.value)
+
+
+def isInline(data):
+    """whether the relations of a value token are kept inline, as a tuple of
+    relation tokens, rather than as a (Length, TreeSet) pair."""
+    kind = type(data[0])
+    return kind is not BTrees.Length.Length and kind is not Length
+
+
+def copyRelations(data):
+    if isInline(data):
+        return data
+    return (copy.copy(data[0]), copy.copy(data[1]))
+
+
+def getForwardMapping(relTools, valueTools, multiple):
+    # relation tokens to the tokens of a value index: sets of them, or, if
+    # the value index is not `multiple`, the one token.
+    key = getKeyType(relTools)
+    value = getKeyType(valueTools)
+    if not multiple and value in 'IL':
+        family = BTrees.family32 if value == 'I' else BTrees.family64
+        if key in 'IL':
+            if key != value:
+                family = BTrees.family64
+            return family.II.BTree
+        elif key == 'O':
+            return family.OI.BTree
+    elif not multiple and value == 'O' and key == 'O':
+        return BTrees.family32.OO.BTree
+    return getMapping(relTools)
+
+
+class ForwardTokens:
+    """the value tokens of the relations in a catalog, as a read-only
+    mapping of (relation token, value index name) to a set of tokens, or
+    None if the relation has no tokens for the value index.
+
+    This is what ``_reltoken_name_TO_objtokenset`` used to be, with a key
+    for each value index of each indexed relation.  Only ``get``, ``[]``
+    and ``in`` are supported.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __contains__(self, key):
+        relToken, name = key
+        return (name in self.catalog._attrs and
+                relToken in self.catalog._relTokens)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self.catalog._getTokens(*key)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.catalog._getTokens(*key)
+
+
 def getMapping(tools):
-    if tools['TreeSet'].__name__[0] == 'I':
+    keyType = getKeyType(tools)
+    if keyType == 'I':
         Mapping = BTrees.family32.IO.BTree
-    elif tools['TreeSet'].__name__[0] == 'L':
+    elif keyType == 'L':
         Mapping = BTrees.family64.IO.BTree
     else:
-        assert tools['TreeSet'].__name__.startswith('O')
+        assert keyType == 'O'
         Mapping = BTrees.family32.OO.BTree
     return Mapping
 
 
+@zope.interface.implementer(interfaces.IRecyclePolicy)
+class RecyclePolicy:
+    """recycles a token set when few of its tokens are removed.
+
+    Fewer than `minRemovals` removals always recycle.  Otherwise, the part
+    of the set that is removed must be at most `ratio`, or, for sets with
+    more than `largeSize` tokens, less than `largeRatio`.  The defaults come
+    from timeit/set_creation_vs_removal.py; `calibrateRecyclePolicy` measures
+    them for a BTrees module on this machine.
+    """
+
+    def __init__(self, minRemovals=5, ratio=0.1, largeSize=500,
+                 largeRatio=0.2):
+        self.minRemovals = minRemovals
+        self.ratio = ratio
+        self.largeSize = largeSize
+        self.largeRatio = largeRatio
+
+    def recycle(self, tokens, removed):
+        # A len is pretty cheap--`removed` is a single bucket, and `tokens`
+        # should have all of its buckets in memory already, and adding up
+        # bucket lens in C is pretty fast.
+        len_removed = len(removed)
+        if len_removed < self.minRemovals:
+            return True
+        len_tokens = len(tokens)
+        ratio = float(len_removed) / len_tokens
+        return (ratio <= self.ratio or
+                len_tokens > self.largeSize and ratio < self.largeRatio)
+
+    def __eq__(self, other):
+        return (isinstance(other, RecyclePolicy) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return (
+            '{}.{}(minRemovals={!r}, ratio={!r}, largeSize={!r}, '
+            'largeRatio={!r})'.format(
+                self.__class__.__module__, self.__class__.__name__,
+                self.minRemovals, self.ratio, self.largeSize,
+                self.largeRatio))
+
+
+def _timeRemoval(TreeSet, source, removed, number):
+    sets = [TreeSet(source) for i in range(number)]
+    start = time.perf_counter()
+    for tokens in sets:
+        for t in removed:
+            tokens.remove(t)
+    return time.perf_counter() - start
+
+
+def _timeCreation(TreeSet, source, number):
+    start = time.perf_counter()
+    for i in range(number):
+        TreeSet(source)
+    return time.perf_counter() - start
+
+
+def _getCrossover(TreeSet, size, repeat):
+    # the fewest removals from a set of `size` tokens that take longer than
+    # building a set of the tokens that are left.
+    number = max(10, 100000 // size)
+
+    def slower(count):
+        removed = [i * size // count for i in range(count)]
+        kept = TreeSet(range(size))
+        for t in removed:
+            kept.remove(t)
+        return (min(_timeRemoval(TreeSet, range(size), removed, number)
+                    for i in range(repeat)) >
+                min(_timeCreation(TreeSet, kept, number)
+                    for i in range(repeat)))
+
+    low, high = 1, size  # removing every token is slower
+    while low < high:
+        middle = (low + high) // 2
+        if slower(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def calibrateRecyclePolicy(btree=None, sizes=(10, 100, 1000, 10000),
+                           largeSize=500, repeat=3):
+    """measure when recycling token sets of the `btree` module is faster
+    than building new ones, and return a RecyclePolicy that says so.
+
+    The smallest of the `sizes` sets `minRemovals`.  The others set `ratio`,
+    for those up to `largeSize`, and `largeRatio`, for the larger ones.
+    """
+    if btree is None:
+        btree = BTrees.family32.IF
+    sizes = sorted(sizes)
+    ratios = {size: float(_getCrossover(btree.TreeSet, size, repeat)) / size
+              for size in sizes[1:]}
+    small = [r for size, r in ratios.items() if size <= largeSize]
+    large = [r for size, r in ratios.items() if size > largeSize]
+    ratio = min(small or large)
+    return RecyclePolicy(
+        _getCrossover(btree.TreeSet, sizes[0], repeat), ratio, largeSize,
+        min(large) if large else ratio)
+
+
 class Ref(persistent.Persistent):
     def __init__(self, ob):
         self.ob = ob
@@ -116,6 +440,213 @@ class Any:
 def any(*args):
     return Any(args)
 
+##############################################################################
+# batches of messages for listeners of one relation at a time
+#
+
+
+@zope.interface.implementer(interfaces.IBatchMessageListener)
+class BatchMessageAdapter:
+    """sends the messages about a batch of relations to a listener that only
+    receives messages about one relation at a time."""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def relationAdded(self, token, catalog, additions):
+        self.listener.relationAdded(token, catalog, additions)
+
+    def relationModified(self, token, catalog, additions, removals):
+        self.listener.relationModified(token, catalog, additions, removals)
+
+    def relationRemoved(self, token, catalog, removals):
+        self.listener.relationRemoved(token, catalog, removals)
+
+    def sourceCleared(self, catalog):
+        self.listener.sourceCleared(catalog)
+
+    def relationsAdded(self, changes, catalog):
+        for token, additions in changes:
+            self.listener.relationAdded(token, catalog, additions)
+
+    def relationsModified(self, changes, catalog):
+        for token, additions, removals in changes:
+            self.listener.relationModified(token, catalog, additions,
+                                           removals)
+
+    def relationsRemoved(self, changes, catalog):
+        for token, removals in changes:
+            self.listener.relationRemoved(token, catalog, removals)
+
+
+def _sendMany(listeners, catalog, added, modified, removed):
+    for listener in listeners:
+        if not interfaces.IBatchMessageListener.providedBy(listener):
+            listener = BatchMessageAdapter(listener)
+        if added:
+            listener.relationsAdded(added, catalog)
+        if modified:
+            listener.relationsModified(modified, catalog)
+        if removed:
+            listener.relationsRemoved(removed, catalog)
+
+
+def getTransaction(ob):
+    """the current transaction of a persistent object's database, or of the
+    default transaction manager if it has none."""
+    if ob._p_jar is not None:
+        return ob._p_jar.transaction_manager.get()
+    return transaction.get()
+
+
+# the kinds of changes
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+
+
+class Changes:
+    """changes to the relations of a catalog, to send to listeners later.
+
+    The changes to each relation are merged, so that listeners are sent the
+    changes since they were last told about the relation.  A relation that
+    was added and then removed is forgotten, unless ``forgetAdded`` is
+    False: the listeners may have found it in the catalog in between, if
+    the catalog has changes that they were not told about yet.
+    """
+
+    def __init__(self, forgetAdded=True):
+        self.data = {}  # token: [kind, additions, removals]
+        self.forgetAdded = forgetAdded
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, kind, token, additions=None, removals=None):
+        data = self.data.get(token)
+        if data is None:
+            data = self.data[token] = [kind, {}, {}]
+        elif kind == REMOVED:
+            if data[0] == ADDED and self.forgetAdded:
+                del self.data[token]  # the listeners never knew it
+                return
+            data[0] = REMOVED
+        elif kind == ADDED:
+            data[0] = MODIFIED  # it was removed before
+        for changes, merged in ((additions, data[1]), (removals, data[2])):
+            if changes:
+                for name, tokens in changes.items():
+                    if tokens:
+                        merged.setdefault(name, set()).update(tokens)
+
+    def send(self, catalog, listeners):
+        added = []
+        modified = []
+        removed = []
+        for token, (kind, additions, removals) in self.data.items():
+            if kind == ADDED:
+                # the relation's values, as when it is indexed
+                added.append((token, {
+                    name: catalog._getTokens(token, name)
+                    for name in catalog._attrs}))
+            elif kind == MODIFIED:
+                modified.append((token, additions, removals))
+            else:
+                removed.append((token, removals))
+        self.data = {}
+        _sendMany(listeners, catalog, added, modified, removed)
+
+    def __copy__(self):
+        res = self.__class__(self.forgetAdded)
+        res.data = {token: [kind, {k: set(v) for k, v in additions.items()},
+                            {k: set(v) for k, v in removals.items()}]
+                    for token, (kind, additions, removals)
+                    in self.data.items()}
+        return res
+
+
+# the catalogs that may have deferred changes, so that searches of the others
+# do not look for them.
+_pendingCatalogs = weakref.WeakSet()
+
+
+class PendingChanges:
+    """a data manager for the changes deferred for the search indexes of a
+    catalog in a transaction.
+
+    It is kept in the transaction's data rather than on the catalog, so that
+    the changes are not lost when the catalog is deactivated.  It sends the
+    changes to the search indexes before the transaction commits, from a
+    before-commit hook that is added again for changes made after it ran,
+    such as those of a later before-commit hook.  If the
+    transaction aborts, the changes are dropped with those of the catalog;
+    unless the catalog is not in a database, so that its changes stand, and
+    are sent.
+    """
+
+    def __init__(self, catalog, txn):
+        self.catalog = catalog
+        self.changes = Changes()
+        self.transaction_manager = None
+        self.hooked = False
+        txn.set_data(catalog, self)
+        txn.join(self)
+
+    def hook(self, txn):
+        # make sure that the changes are sent before the transaction commits
+        if not self.hooked:
+            self.hooked = True
+            txn.addBeforeCommitHook(self.beforeCommit)
+
+    def beforeCommit(self):
+        self.hooked = False
+        self.send()
+
+    def send(self):
+        _pendingCatalogs.discard(self.catalog)
+        if self.changes:
+            self.changes.send(
+                self.catalog, [ix for ix, keys in self.catalog._searchIndexes])
+
+    def abort(self, txn):
+        if self.catalog._p_jar is None:
+            self.send()
+        self.changes = Changes()
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        self.abort(txn)
+
+    def sortKey(self):
+        return 'zc.relation.catalog.PendingChanges:%d' % id(self)
+
+    def savepoint(self):
+        return PendingChangesSavepoint(self)
+
+
+class PendingChangesSavepoint:
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.changes = copy.copy(manager.changes)
+
+    def rollback(self):
+        if self.manager.catalog._p_jar is not None:
+            # the catalog is back to the savepoint, and so are its changes
+            self.manager.changes = copy.copy(self.changes)
+            _pendingCatalogs.add(self.manager.catalog)
+
 ##############################################################################
 # the marker that shows that a path is circular
 #
@@ -132,6 +663,219 @@ class CircularRelationPath(tuple):
     def __repr__(self):
         return 'cycle%s' % super().__repr__()
 
+##############################################################################
+# the chains that the search engine walks
+#
+
+
+_CHAIN_BLOCK_SIZE = 16
+
+
+class _Chain(collections.abc.Sequence):
+    """A relation token chain in a search, linked to the chain it extends.
+
+    Chains share their parents, so extending a chain costs the same at any
+    depth.  For cycle checks, a chain keeps the tokens of its last few links
+    in a small frozenset and shares the frozensets of the earlier links with
+    its parent.  Filters and query factories get the chain itself, which acts
+    as a sequence; a tuple is only built when it is asked for, as when a
+    search yields the chain.
+    """
+
+    __slots__ = ('token', 'parent', 'length', '_tokens', '_earlier', '_tuple')
+
+    def __init__(self, token, parent=None):
+        self.token = token
+        self.parent = parent
+        self._tuple = None
+        if parent is None:
+            self.length = 1
+            self._tokens = frozenset((token,))
+            self._earlier = None
+        else:
+            self.length = parent.length + 1
+            if len(parent._tokens) < _CHAIN_BLOCK_SIZE:
+                self._tokens = parent._tokens.union((token,))
+                self._earlier = parent._earlier
+            else:
+                self._tokens = frozenset((token,))
+                self._earlier = (parent._tokens, parent._earlier)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, token):
+        if token in self._tokens:
+            return True
+        earlier = self._earlier
+        while earlier is not None:
+            tokens, earlier = earlier
+            if token in tokens:
+                return True
+        return False
+
+    def intersects(self, tokens):
+        for token in tokens:
+            if token in self:
+                return True
+        return False
+
+    def __getitem__(self, index):
+        if not isinstance(index, int):
+            return self.tuple()[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('chain index out of range')
+        chain = self
+        for i in range(self.length - 1 - index):
+            chain = chain.parent
+        return chain.token
+
+    def __iter__(self):
+        return iter(self.tuple())
+
+    def tuple(self):
+        if self._tuple is None:
+            tokens = []
+            chain = self
+            while chain is not None and chain._tuple is None:
+                tokens.append(chain.token)
+                chain = chain.parent
+            tokens.reverse()
+            if chain is not None:
+                tokens[:0] = chain._tuple
+            self._tuple = tuple(tokens)
+        return self._tuple
+
+    def __eq__(self, other):
+        if isinstance(other, _Chain):
+            other = other.tuple()
+        return self.tuple() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.tuple())
+
+    def __add__(self, other):
+        return self.tuple() + tuple(other)
+
+    def __radd__(self, other):
+        return tuple(other) + self.tuple()
+
+    def __repr__(self):
+        return repr(self.tuple())
+
+##############################################################################
+# prepared queries
+#
+
+
+@zope.interface.implementer(interfaces.IPreparedQuery)
+class PreparedQuery:
+    """A search whose shape is settled once, to be run with many values.
+
+    The names and depth of the search are checked when the plan is
+    prepared.  The plan remembers the search indexes that may answer its
+    queries until the catalog's search indexes change, and searches of one
+    relation with no filters do not ask the query factories.
+    """
+
+    def __init__(self, catalog, name=None, queryNames=(), maxDepth=None,
+                 filter=None, targetNames=(), targetFilter=None,
+                 queryFactory=None, ignoreSearchIndex=False):
+        if name is not None and name not in catalog._attrs:
+            raise ValueError('name not indexed', name)
+        queryNames = tuple(queryNames)
+        targetNames = tuple(targetNames)
+        for names in (queryNames, targetNames):
+            for nm in names:
+                if nm is not RELATION and nm not in catalog._attrs:
+                    raise ValueError('name not indexed', nm)
+            if len(set(names)) != len(names):
+                raise ValueError('duplicate names', names)
+        _checkMaxDepth(maxDepth)
+        self.catalog = catalog
+        self.name = name
+        self.queryNames = queryNames
+        self.maxDepth = maxDepth
+        self.filter = filter
+        self.targetNames = targetNames
+        self.targetFilter = targetFilter
+        self.queryFactory = queryFactory
+        self.ignoreSearchIndex = ignoreSearchIndex
+        # searches of one relation, with no filters, need no query factory
+        self._direct = (maxDepth == 1 and filter is None and
+                        not targetNames and targetFilter is None)
+        self._count = len(queryNames) + len(targetNames)
+        self._noTargets = BTrees.family32.OO.Bucket()  # never changed
+        self._searchIndexes = None
+        self._matches = []  # (name, queryFactory, matches)
+
+    def __repr__(self):
+        return '<%s %r %r>' % (
+            self.__class__.__name__, self.name,
+            self.queryNames + self.targetNames)
+
+    def _getQueries(self, values):
+        # the query and the targetQuery for the values
+        if len(values) != self._count:
+            raise TypeError('expected %d values, got %d' % (
+                self._count, len(values)))
+        query = BTrees.family32.OO.Bucket(list(zip(self.queryNames, values)))
+        if not self.targetNames:
+            return query, self._noTargets
+        targetValues = values[len(self.queryNames):]
+        return query, BTrees.family32.OO.Bucket(
+            list(zip(self.targetNames, targetValues)))
+
+    def _getQueryFactory(self, query):
+        if self.queryFactory is not None:
+            # as the catalog does, ask the factory when the search needs it
+            return self.queryFactory, None
+        if self._direct:
+            return None, None
+        return self.catalog._getQueryFactory(query, None)
+
+    def _getMatches(self, name, query, maxDepth, filter, queryFactory):
+        # the catalog's _getSearchIndexMatches, computed once for each
+        # query factory, as the names of the queries do not change
+        if self.catalog._searchIndexes is not self._searchIndexes:
+            self._searchIndexes = self.catalog._searchIndexes
+            self._matches = []
+        for c_name, c_queryFactory, matches in self._matches:
+            if c_name == name and c_queryFactory is queryFactory:
+                return matches
+        matches = self.catalog._getSearchIndexMatches(
+            name, query, maxDepth, filter, queryFactory)
+        self._matches.append((name, queryFactory, matches))
+        return matches
+
+    def find(self, *values):
+        query, targetQuery = self._getQueries(values)
+        queryFactory, getQueries = self._getQueryFactory(query)
+        getMatches = None if self.ignoreSearchIndex else self._getMatches
+        if self.name is None:
+            return self.catalog._findRelationTokens(
+                query, self.maxDepth, self.filter, targetQuery,
+                self.targetFilter, queryFactory, getQueries, getMatches)
+        data = self.catalog._attrs.get(self.name)
+        if data is None:
+            raise ValueError('name not indexed', self.name)
+        return self.catalog._findValueTokens(
+            self.name, data, query, self.maxDepth, self.filter, targetQuery,
+            self.targetFilter, queryFactory, getQueries, getMatches)
+
+    def canFind(self, *values):
+        query, targetQuery = self._getQueries(values)
+        queryFactory, getQueries = self._getQueryFactory(query)
+        return self.catalog._canFind(
+            query, self.maxDepth, self.filter, targetQuery,
+            self.targetFilter, queryFactory, getQueries,
+            None if self.ignoreSearchIndex else self._getMatches)
+
 ##############################################################################
 # the relation catalog
 
@@ -142,6 +886,14 @@ class Catalog(persistent.Persistent):
     family = BTrees.family32
     _listeners = _queryFactories = _searchIndexes = ()
     _searchIndexMatches = None
+    _fingerprints = None
+    # catalogs from before _name_TO_forward have their value tokens in
+    # _reltoken_name_TO_objtokenset, until ``migrate`` moves them.
+    _name_TO_forward = _forwardLegacy = _forwardCursor = None
+    inlineLimit = 0
+    recyclePolicy = RecyclePolicy()
+    _Length = BTrees.Length.Length
+    deferred = False
 
     def __init__(self, dump, load, btree=None, family=None):
         # instantiate with instructions on how to dump and load relations,
@@ -156,13 +908,15 @@ class Catalog(persistent.Persistent):
         self._name_TO_mapping = family.OO.BTree()
         # held mappings are objtoken to (relcount, relset)
         self._EMPTY_name_TO_relcount_relset = family.OO.BTree()
-        self._reltoken_name_TO_objtokenset = family.OO.BTree()
+        # held mappings are reltoken to objtokenset, or to the objtoken for
+        # value indexes that are not ``multiple``
+        self._name_TO_forward = family.OO.BTree()
         if btree is None:
             btree = family.IF
         self._relTools = getModuleTools(btree)
         self._relTools['load'] = load
         self._relTools['dump'] = dump
-        self._relLength = BTrees.Length.Length()
+        self._relLength = self._Length()
         self._relTokens = self._relTools['TreeSet']()
         # private; only mutate via indexValue and unindexValue
         self._attrs = self.family.OO.Bucket()  # _attrs name is legacy
@@ -202,13 +956,27 @@ class Catalog(persistent.Persistent):
         for v in self._name_TO_mapping.values():
             v.clear()
         self._EMPTY_name_TO_relcount_relset.clear()
-        self._reltoken_name_TO_objtokenset.clear()
+        if self._name_TO_forward is None:
+            self.__dict__['_reltoken_name_TO_objtokenset'].clear()
+        else:
+            for v in self._name_TO_forward.values():
+                v.clear()
+            self._forwardLegacy = self._forwardCursor = None  # migrated
         self._relTokens.clear()
         self._relLength.set(0)
+        if self._fingerprints is not None:
+            self._fingerprints.clear()
+        if self in _pendingCatalogs:  # the search indexes start again
+            _pendingCatalogs.discard(self)
+            try:
+                getTransaction(self).data(self).changes = Changes()
+            except KeyError:
+                pass
         for listener in self._iterListeners():
             listener.sourceCleared(self)
 
     def copy(self, klass=None):
+        self.updateSearchIndexes()
         if klass is None:
             klass = self.__class__
         res = klass.__new__(klass)
@@ -218,22 +986,30 @@ class Catalog(persistent.Persistent):
         res._name_TO_mapping = self.family.OO.BTree()
         for name, mapping in self._name_TO_mapping.items():
             new = mapping.__class__()
-            for k, (l, s) in mapping.items():
-                new[k] = (copy.copy(l), copy.copy(s))
+            for k, data in mapping.items():
+                new[k] = copyRelations(data)
             res._name_TO_mapping[name] = new
         res._EMPTY_name_TO_relcount_relset = self.family.OO.BTree()
-        for k, (l, s) in self._EMPTY_name_TO_relcount_relset.items():
-            res._EMPTY_name_TO_relcount_relset[k] = (
-                copy.copy(l), copy.copy(s))
-        res._reltoken_name_TO_objtokenset = self.family.OO.BTree()
-        for k, s in self._reltoken_name_TO_objtokenset.items():
-            res._reltoken_name_TO_objtokenset[k] = copy.copy(s)
+        for k, data in self._EMPTY_name_TO_relcount_relset.items():
+            res._EMPTY_name_TO_relcount_relset[k] = copyRelations(data)
         res._attrs = self.family.OO.Bucket(
             [(k, self.family.OO.Bucket(v)) for k, v in self._attrs.items()])
+        res._name_TO_forward = self.family.OO.BTree()
+        for name, data in res._attrs.items():
+            res._name_TO_forward[name] = self._createForward(data)
+            for token in self._relTokens:
+                tokens = self._getTokens(token, name)
+                if tokens is not None:
+                    res._setTokens(token, name, copy.copy(tokens))
         res._relTools = dict(self._relTools)
         res._queryFactories = self._queryFactories  # it's a tuple
-        res._relLength = BTrees.Length.Length()
-        res._relLength.set(self._relLength.value)
+        res._relLength = self._Length(self._relLength.value)
+        for name in ('inlineLimit', 'recyclePolicy'):
+            if name in self.__dict__:
+                setattr(res, name, getattr(self, name))
+        if self._fingerprints is not None:
+            res._fingerprints = self._fingerprints.__class__(
+                self._fingerprints)
         if self._searchIndexMatches is not None:
             indexes = []
             res._searchIndexMatches = self.family.OO.Bucket()
@@ -262,13 +1038,15 @@ class Catalog(persistent.Persistent):
             self._attrs = self.family.OO.Bucket(self._attrs)
 
     def addValueIndex(self, element, dump=None, load=None, btree=None,
-                      multiple=False, name=None):
+                      multiple=False, name=None, recyclePolicy=None):
         if btree is None:
             btree = self.family.IF
         value_index_info = self.family.OO.Bucket(getModuleTools(btree))
         value_index_info['dump'] = dump
         value_index_info['load'] = load
         value_index_info['multiple'] = multiple
+        if recyclePolicy is not None:
+            value_index_info['recyclePolicy'] = recyclePolicy
         if (value_index_info['dump'] is None) \
                 ^ (value_index_info['load'] is None):
             raise ValueError(
@@ -297,11 +1075,15 @@ class Catalog(persistent.Persistent):
         if name in self._attrs:
             raise ValueError('name already used', name)
         value_index_info['name'] = name
-        self._name_TO_mapping[name] = getMapping(value_index_info)()
+        self._name_TO_mapping[name] = self._createMapping(value_index_info)
+        if self._name_TO_forward is not None:
+            self._name_TO_forward[name] = self._createForward(
+                value_index_info)
         # these are objtoken to (relcount, relset)
         self._attrs[name] = value_index_info
         load = self._relTools['load']
         cache = {}
+        self.updateSearchIndexes()  # so that they hear of changes in order
         for token in self._relTokens:
             additions = {}
             additions[name] = (None, self._indexNew(
@@ -309,6 +1091,7 @@ class Catalog(persistent.Persistent):
             for listener in self._iterListeners():
                 listener.relationModified(token, self, additions, {})
         self._fixLegacyAttrs()
+        self._updateFingerprints()
 
     def iterValueIndexInfo(self):
         for d in self._attrs.values():
@@ -319,6 +1102,7 @@ class Catalog(persistent.Persistent):
             res['dump'] = d['dump']
             res['load'] = d['load']
             res['btree'] = sys.modules[d['TreeSet'].__module__]
+            res['recyclePolicy'] = d.get('recyclePolicy')
             yield res
 
     def removeValueIndex(self, name):
@@ -327,6 +1111,175 @@ class Catalog(persistent.Persistent):
         del self._name_TO_mapping[name]
         if name in self._EMPTY_name_TO_relcount_relset:
             del self._EMPTY_name_TO_relcount_relset[name]
+        if self._name_TO_forward is not None:
+            del self._name_TO_forward[name]
+        legacy = self._getLegacyForward()
+        if legacy is not None:
+            for token in self._relTokens:
+                legacy.pop((token, name), None)
+        self._updateFingerprints()
+
+    # Value Tokens of Relations
+    # -------------------------
+
+    def _createMapping(self, data):
+        # value token to relations
+        return getMapping(data)()
+
+    def _createForward(self, data):
+        return getForwardMapping(
+            self._relTools, data, data['multiple'])()
+
+    def _getLegacyForward(self, relToken=_marker):
+        # the legacy mapping of (relToken, name) to tokens, if it has the
+        # tokens of `relToken` (or, without a relToken, if there is one).
+        if self._name_TO_forward is None:
+            return self.__dict__['_reltoken_name_TO_objtokenset']
+        legacy = self._forwardLegacy
+        if legacy is not None and (
+                relToken is _marker or self._forwardCursor is None or
+                relToken > self._forwardCursor[0]):
+            return legacy
+        return None
+
+    @property
+    def _reltoken_name_TO_objtokenset(self):
+        # legacy API, used by zc.relationship
+        return ForwardTokens(self)
+
+    @_reltoken_name_TO_objtokenset.setter
+    def _reltoken_name_TO_objtokenset(self, value):
+        raise AttributeError(
+            '_reltoken_name_TO_objtokenset is a read-only view; the value '
+            'tokens of relations change when they are indexed')
+
+    @_reltoken_name_TO_objtokenset.deleter
+    def _reltoken_name_TO_objtokenset(self):
+        raise AttributeError(
+            '_reltoken_name_TO_objtokenset is a read-only view; the value '
+            'tokens of relations change when they are indexed')
+
+    def _getTokens(self, relToken, name):
+        # the set of the tokens of a relation for a value index, or None
+        legacy = self._getLegacyForward(relToken)
+        if legacy is not None:
+            return legacy.get((relToken, name))
+        res = self._name_TO_forward[name].get(relToken)
+        if res is not None:
+            data = self._attrs[name]
+            if not data['multiple']:
+                res = data['TreeSet']((res,))
+        return res
+
+    def _setTokens(self, relToken, name, tokens):
+        legacy = self._getLegacyForward(relToken)
+        if legacy is not None:
+            legacy[(relToken, name)] = tokens
+        elif not tokens:
+            self._name_TO_forward[name].pop(relToken, None)
+        elif self._attrs[name]['multiple']:
+            self._name_TO_forward[name][relToken] = tokens
+        else:
+            assert len(tokens) == 1, 'Internal error: many values for one'
+            self._name_TO_forward[name][relToken] = tokens.minKey()
+
+    def _popTokens(self, relToken, name):
+        legacy = self._getLegacyForward(relToken)
+        if legacy is not None:
+            return legacy.pop((relToken, name))
+        res = self._getTokens(relToken, name)
+        self._name_TO_forward[name].pop(relToken, None)
+        return res
+
+    def _unionTokens(self, rels, name):
+        # the tokens of the relations for a value index
+        data = self._attrs[name]
+        if (not data['multiple'] and self._name_TO_forward is not None and
+                self._forwardLegacy is None):
+            get = self._name_TO_forward[name].get
+            return data['Set'](
+                t for t in (get(r) for r in rels) if t is not None)
+        return multiunion((self._getTokens(r, name) for r in rels), data)
+
+    def migrate(self, size=None):
+        legacy = self._getLegacyForward()
+        if legacy is None:
+            return False
+        if self._name_TO_forward is None:
+            self._forwardLegacy = legacy
+            self._name_TO_forward = self.family.OO.BTree(
+                [(name, self._createForward(data))
+                 for name, data in self._attrs.items()])
+            del self.__dict__['_reltoken_name_TO_objtokenset']
+            self._p_changed = True
+        if self._forwardCursor is None:
+            tokens = self._relTokens.keys()
+        else:
+            tokens = self._relTokens.keys(
+                min=self._forwardCursor[0], excludemin=True)
+        count = 0
+        for token in tokens:
+            if size is not None and count >= size:
+                return True
+            self._forwardCursor = (token,)
+            for name in self._attrs:
+                self._setTokens(token, name, legacy.get((token, name)))
+            count += 1
+        self._forwardLegacy = self._forwardCursor = None
+        return False
+
+    # Fingerprints
+    # ------------
+
+    def addFingerprints(self):
+        if self._fingerprints is not None:
+            raise ValueError('fingerprints already kept')
+        self._fingerprints = self._createFingerprints()
+        self._updateFingerprints()
+
+    def removeFingerprints(self):
+        if self._fingerprints is None:
+            raise LookupError('fingerprints not kept')
+        self._fingerprints = None
+
+    def getFingerprint(self, token):
+        if self._fingerprints is None:
+            return None
+        return self._fingerprints.get(token)
+
+    def _createFingerprints(self):
+        return getFingerprintMapping(self._relTools)()
+
+    def _getIndexedFingerprint(self, relToken):
+        return fingerprint(
+            self._getTokens(relToken, name) for name in self._attrs)
+
+    def _updateFingerprints(self):
+        if self._fingerprints is not None:
+            self._fingerprints.clear()
+            for token in self._relTokens:
+                self._fingerprints[token] = self._getIndexedFingerprint(
+                    token)
+
+    def _getFound(self, relToken, rel, indexes, names):
+        # the values and tokens for each of the value indexes to reindex,
+        # with the relation's new fingerprint if they are all reindexed; or
+        # None if the fingerprint shows that nothing changed.
+        if self._fingerprints is None:
+            return [None] * len(indexes), None
+        found = [self._getValueTokens(rel, data) for data in indexes]
+        if names is not None:
+            return found, None
+        res = fingerprint(tokens for values, tokens in found)
+        if self._fingerprints.get(relToken) == res:
+            return None
+        return found, res
+
+    def _setFingerprint(self, relToken, value=None):
+        if self._fingerprints is not None:
+            if value is None:
+                value = self._getIndexedFingerprint(relToken)
+            self._fingerprints[relToken] = value
 
     # Listeners
     # -----------
@@ -405,6 +1358,7 @@ class Catalog(persistent.Persistent):
     # --------------
 
     def addSearchIndex(self, ix):
+        self.updateSearchIndexes()
         matches = tuple(ix.setCatalog(self))
         if self._searchIndexMatches is None:
             self._searchIndexMatches = self.family.OO.Bucket()
@@ -451,6 +1405,7 @@ class Catalog(persistent.Persistent):
         return (data[0] for data in self._searchIndexes)
 
     def removeSearchIndex(self, ix):
+        self.updateSearchIndexes()
         res = []
         keys = None
         for data in self._searchIndexes:
@@ -482,75 +1437,98 @@ class Catalog(persistent.Persistent):
     # ---------
 
     def _indexNew(self, token, rel, value_index_info):
-        assert self._reltoken_name_TO_objtokenset.get(
-            (token, value_index_info['name']), self) is self
+        tokens = self._getNewTokens(rel, value_index_info)
+        self._add(token, tokens, value_index_info['name'], tokens)
+        return tokens
+
+    def _getNewTokens(self, rel, value_index_info, found=None):
         values, tokens, optimization = self._getValuesAndTokens(
-            rel, value_index_info)
+            rel, value_index_info, found)
         if optimization and tokens is not None:
             tokens = value_index_info['TreeSet'](tokens)
-        self._add(token, tokens, value_index_info['name'], tokens)
         return tokens
 
-    def index(self, rel):
-        self.index_doc(self._relTools['dump'](rel, self, {}), rel)
+    def _getChanges(self, relToken, rel, data, found=None):
+        # the new tokens of an indexed relation for a value index, with the
+        # tokens added and removed; or None if nothing changed.
+        values, newTokens, optimization = self._getValuesAndTokens(
+            rel, data, found)
+        oldTokens = self._getTokens(relToken, data['name'])
+        if newTokens == oldTokens:
+            return None
+        if newTokens is not None and oldTokens is not None:
+            added = data['difference'](newTokens, oldTokens)
+            removed = data['difference'](oldTokens, newTokens)
+            if optimization:
+                # the goal of this optimization is to not have to
+                # recreate a TreeSet (which can be large and
+                # relatively timeconsuming) when only small changes
+                # have been made.  We ballpark this by saying
+                # "if there are only a few removals, do them, and
+                # then do an update: it's almost certainly a win
+                # over essentially generating a new TreeSet and
+                # updating it with *all* values.  On the other
+                # hand, if there are a lot of removals, it's
+                # probably quicker just to make a new one."  The
+                # recycle policy says what "a few" is (see
+                # RecyclePolicy).
+                policy = data.get('recyclePolicy')
+                if policy is None:
+                    policy = self.recyclePolicy
+                if not removed or policy.recycle(oldTokens, removed):
+                    for t in removed:
+                        oldTokens.remove(t)
+                    oldTokens.update(added)
+                    newTokens = oldTokens
+                else:
+                    newTokens = data['TreeSet'](newTokens)
+        else:
+            if optimization and newTokens is not None:
+                newTokens = data['TreeSet'](newTokens)
+            removed = oldTokens
+            added = newTokens
+        return newTokens, added, removed
+
+    def _getValueIndexes(self, names):
+        # the value indexes to reindex: all of them, or the named ones.
+        if names is None:
+            return self._attrs.values()
+        if isinstance(names, str):
+            names = (names,)
+        res = []
+        for name in names:
+            data = self._attrs.get(name)
+            if data is None:
+                raise ValueError('name not indexed', name)
+            res.append(data)
+        return res
 
-    def index_doc(self, relToken, rel):
+    def index(self, rel, names=None):
+        self.index_doc(self._relTools['dump'](rel, self, {}), rel, names)
+
+    def index_doc(self, relToken, rel, names=None):
         additions = {}
         removals = {}
         if relToken in self._relTokens:
             # reindex
-            for data in self._attrs.values():
-                values, newTokens, optimization = self._getValuesAndTokens(
-                    rel, data)
-                oldTokens = self._reltoken_name_TO_objtokenset[
-                    (relToken, data['name'])]
-                if newTokens != oldTokens:
-                    if newTokens is not None and oldTokens is not None:
-                        added = data['difference'](newTokens, oldTokens)
-                        removed = data['difference'](oldTokens, newTokens)
-                        if optimization:
-                            # the goal of this optimization is to not have to
-                            # recreate a TreeSet (which can be large and
-                            # relatively timeconsuming) when only small changes
-                            # have been made.  We ballpark this by saying
-                            # "if there are only a few removals, do them, and
-                            # then do an update: it's almost certainly a win
-                            # over essentially generating a new TreeSet and
-                            # updating it with *all* values.  On the other
-                            # hand, if there are a lot of removals, it's
-                            # probably quicker just to make a new one."  See
-                            # timeit/set_creation_vs_removal.py for details.
-                            # A len is pretty cheap--`removed` is a single
-                            # bucket, and `oldTokens` should have all of its
-                            # buckets in memory already, and adding up bucket
-                            # lens in C is pretty fast.
-                            len_removed = len(removed)
-                            if len_removed < 5:
-                                recycle = True
-                            else:
-                                len_old = len(oldTokens)
-                                ratio = float(len_old) / len_removed
-                                recycle = (ratio <= 0.1 or len_old > 500
-                                           and ratio < 0.2)
-                            if recycle:
-                                for t in removed:
-                                    oldTokens.remove(t)
-                                oldTokens.update(added)
-                                newTokens = oldTokens
-                            else:
-                                newTokens = data['TreeSet'](newTokens)
-                    else:
-                        if optimization and newTokens is not None:
-                            newTokens = data['TreeSet'](newTokens)
-                        removed = oldTokens
-                        added = newTokens
+            indexes = self._getValueIndexes(names)
+            found = self._getFound(relToken, rel, indexes, names)
+            if found is None:
+                return  # the fingerprint is the same: nothing changed
+            found, value = found
+            for data, f in zip(indexes, found):
+                changes = self._getChanges(relToken, rel, data, f)
+                if changes is not None:
+                    newTokens, added, removed = changes
                     self._remove(relToken, removed, data['name'])
                     if removed:
                         removals[data['name']] = removed
                     self._add(relToken, added, data['name'], newTokens)
                     if added:
                         additions[data['name']] = added
-            for listener in self._iterListeners():
+            self._setFingerprint(relToken, value)
+            for listener in self._getListeners(
+                    modified=((relToken, additions, removals),)):
                 listener.relationModified(relToken, self, additions, removals)
         else:
             # new token
@@ -559,7 +1537,9 @@ class Catalog(persistent.Persistent):
                     relToken, rel, value_index_info)
             self._relTokens.insert(relToken)
             self._relLength.change(1)
-            for listener in self._iterListeners():
+            self._setFingerprint(relToken)
+            for listener in self._getListeners(
+                    added=((relToken, additions),)):
                 listener.relationAdded(relToken, self, additions)
 
     def unindex(self, rel):
@@ -569,20 +1549,148 @@ class Catalog(persistent.Persistent):
         removals = {}
         if relToken in self._relTokens:
             for value_index_info in self._attrs.values():
-                tokens = self._reltoken_name_TO_objtokenset.pop(
-                    (relToken, value_index_info['name']))
+                tokens = self._popTokens(
+                    relToken, value_index_info['name'])
                 if tokens:
                     removals[value_index_info['name']] = tokens
                 self._remove(relToken, tokens, value_index_info['name'])
             self._relTokens.remove(relToken)
             self._relLength.change(-1)
-        for listener in self._iterListeners():
+            if self._fingerprints is not None:
+                del self._fingerprints[relToken]
+        for listener in self._getListeners(removed=((relToken, removals),)):
             listener.relationRemoved(relToken, self, removals)
 
+    # Many at Once
+    # ------------
+
+    def indexMany(self, rels, names=None):
+        dump = self._relTools['dump']
+        cache = {}
+        self.index_docs(
+            ((dump(rel, self, cache), rel) for rel in rels), names)
+
+    def index_docs(self, pairs, names=None):
+        indexes = self._getValueIndexes(names)
+        rels = {}
+        for relToken, rel in pairs:
+            rels[relToken] = rel  # the last relation for a token wins
+        additions = {}  # name: {value token: [relation tokens]}
+        removals = {}
+        added = []
+        modified = []
+        for relToken, rel in rels.items():
+            relAdditions = {}
+            if relToken in self._relTokens:
+                found = self._getFound(relToken, rel, indexes, names)
+                if found is None:
+                    continue  # the fingerprint is the same
+                found, value = found
+                relRemovals = {}
+                for data, f in zip(indexes, found):
+                    changes = self._getChanges(relToken, rel, data, f)
+                    if changes is not None:
+                        newTokens, tokensAdded, tokensRemoved = changes
+                        name = data['name']
+                        self._setTokens(relToken, name, newTokens)
+                        self._collect(removals, relToken, tokensRemoved, name)
+                        if tokensRemoved:
+                            relRemovals[name] = tokensRemoved
+                        self._collect(additions, relToken, tokensAdded, name)
+                        if tokensAdded:
+                            relAdditions[name] = tokensAdded
+                self._setFingerprint(relToken, value)
+                modified.append((relToken, relAdditions, relRemovals))
+            else:
+                for data in self._attrs.values():
+                    tokens = self._getNewTokens(rel, data)
+                    self._setTokens(relToken, data['name'], tokens)
+                    self._collect(additions, relToken, tokens, data['name'])
+                    relAdditions[data['name']] = tokens
+                added.append((relToken, relAdditions))
+                self._setFingerprint(relToken)
+        self._removeMany(removals)
+        self._addMany(additions)
+        if added:
+            self._relTokens.update([relToken for relToken, a in added])
+            self._relLength.change(len(added))
+        self._notifyMany(added, modified, ())
+
+    def unindexMany(self, rels):
+        dump = self._relTools['dump']
+        cache = {}
+        self.unindex_docs(dump(rel, self, cache) for rel in rels)
+
+    def unindex_docs(self, relTokens):
+        removals = {}
+        removed = []
+        count = 0
+        for relToken in dict.fromkeys(relTokens):
+            relRemovals = {}
+            if relToken in self._relTokens:
+                for data in self._attrs.values():
+                    tokens = self._popTokens(relToken, data['name'])
+                    if tokens:
+                        relRemovals[data['name']] = tokens
+                    self._collect(removals, relToken, tokens, data['name'])
+                self._relTokens.remove(relToken)
+                if self._fingerprints is not None:
+                    del self._fingerprints[relToken]
+                count += 1
+            removed.append((relToken, relRemovals))
+        self._removeMany(removals)
+        if count:
+            self._relLength.change(-count)
+        self._notifyMany((), (), removed)
+
+    def _notifyMany(self, added, modified, removed):
+        _sendMany(self._getListeners(added, modified, removed), self,
+                  added, modified, removed)
+
+    # Deferred Search Indexes
+    # -----------------------
+
+    def _getListeners(self, added=(), modified=(), removed=()):
+        # the listeners to tell about the changes now.  If the catalog is
+        # ``deferred``, the search indexes are told later.
+        if not self.deferred or not self._searchIndexes:
+            return self._iterListeners()
+        pending = self._getPending()
+        for relToken, additions in added:
+            pending.add(ADDED, relToken, additions)
+        for relToken, additions, removals in modified:
+            pending.add(MODIFIED, relToken, additions, removals)
+        for relToken, removals in removed:
+            pending.add(REMOVED, relToken, None, removals)
+        return self.iterListeners()
+
+    def _getPending(self):
+        txn = getTransaction(self)
+        try:
+            manager = txn.data(self)
+        except KeyError:
+            manager = PendingChanges(self, txn)
+        manager.hook(txn)
+        _pendingCatalogs.add(self)
+        return manager.changes
+
+    def updateSearchIndexes(self):
+        if self not in _pendingCatalogs:
+            return
+        try:
+            manager = getTransaction(self).data(self)
+        except KeyError:
+            # the changes were of a transaction that ended
+            _pendingCatalogs.discard(self)
+            return
+        manager.send()
+
     # Indexing Values
     # ---------------
 
-    def _getValuesAndTokens(self, rel, data):
+    def _getValueTokens(self, rel, data):
+        # the values of a relation for a value index, and their tokens,
+        # without building a set.
         values = None
         if 'interface' in data:
             valueSource = data['interface'](rel, None)
@@ -595,26 +1703,34 @@ class Catalog(persistent.Persistent):
         if not data['multiple'] and values is not None:
             # None is a marker for no value
             values = (values,)
+        if not values:
+            return values, values
+        if data['dump'] is None:
+            if iter(values) is values:
+                values = tuple(values)  # tokens may be read twice
+            return values, values
+        cache = {}
+        return values, [data['dump'](o, self, cache) for o in values]
+
+    def _getValuesAndTokens(self, rel, data, found=None):
+        if found is None:
+            found = self._getValueTokens(rel, data)
+        values, tokens = found
         optimization = data['dump'] is None and (
             values is None or
-            isinstance(values, (
-                data['TreeSet'], data['BTree'], data['Bucket'], data['Set'])))
+            isinstance(values, tuple(
+                data[nm] for nm in ('TreeSet', 'BTree', 'Bucket', 'Set')
+                if data[nm] is not None)))
         if not values:
             return None, None, optimization
         elif optimization:
             # this is the optimization story (see _add)
             return values, values, optimization
         else:
-            cache = {}
-            if data['dump'] is None:
-                tokens = data['TreeSet'](values)
-            else:
-                tokens = data['TreeSet'](
-                    data['dump'](o, self, cache) for o in values)
-            return values, tokens, False
+            return values, data['TreeSet'](tokens), False
 
     def _add(self, relToken, tokens, name, fullTokens):
-        self._reltoken_name_TO_objtokenset[(relToken, name)] = fullTokens
+        self._setTokens(relToken, name, fullTokens)
         if tokens is None:
             dataset = self._EMPTY_name_TO_relcount_relset
             keys = (name,)
@@ -622,14 +1738,7 @@ class Catalog(persistent.Persistent):
             dataset = self._name_TO_mapping[name]
             keys = tokens
         for key in keys:
-            data = dataset.get(key)
-            if data is None:
-                data = dataset[key] = (
-                    BTrees.Length.Length(), self._relTools['TreeSet']())
-            res = data[1].insert(relToken)
-
-            assert res, 'Internal error: relToken existed in data'
-            data[0].change(1)
+            self._addRelations(dataset, key, (relToken,))
 
     def _remove(self, relToken, tokens, name):
         """
@@ -644,17 +1753,85 @@ class Catalog(persistent.Persistent):
             dataset = self._name_TO_mapping[name]
             keys = tokens
         for key in keys:
-            try:
-                data = dataset[key]
-            except KeyError:
-                BTrees.check.check(dataset)
-                raise
-            data[1].remove(relToken)
-            data[0].change(-1)
-            if not data[0].value:
-                del dataset[key]
+            self._removeRelations(dataset, key, (relToken,))
+
+    def _addRelations(self, dataset, key, relTokens):
+        # the relations of a value token are a tuple while they are no more
+        # than ``inlineLimit``, and then a (Length, TreeSet) pair.
+        data = dataset.get(key)
+        if data is None or isInline(data):
+            old = data or ()
+            if len(old) + len(relTokens) <= self.inlineLimit:
+                new = old + tuple(relTokens)
+                assert len(set(new)) == len(new), (
+                    'Internal error: relToken existed in data')
+                dataset[key] = new
+                return
+            data = dataset[key] = (
+                self._Length(len(old)),
+                self._relTools['TreeSet'](old))
+        res = data[1].update(relTokens)
+        assert res == len(relTokens), (
+            'Internal error: relToken existed in data')
+        data[0].change(res)
+
+    def _removeRelations(self, dataset, key, relTokens):
+        try:
+            data = dataset[key]
+        except KeyError:
+            BTrees.check.check(dataset)
+            raise
+        if isInline(data):
+            removed = set(relTokens)
+            new = tuple(t for t in data if t not in removed)
+            assert len(new) == len(data) - len(removed), (
+                'Internal error: relToken not in data')
+            if new:
+                dataset[key] = new
             else:
-                assert data[0].value > 0
+                del dataset[key]
+        elif data[0].value == len(relTokens):
+            del dataset[key]
+        else:
+            for relToken in relTokens:
+                data[1].remove(relToken)
+            data[0].change(-len(relTokens))
+            assert data[0].value > 0
+
+    def _getRelations(self, data):
+        # the number of relations of a value token, and their set.
+        if data is None:
+            return 0, None
+        if isInline(data):
+            return len(data), self._relTools['Set'](data)
+        return data[0].value, data[1]
+
+    def _collect(self, changes, relToken, tokens, name):
+        # gather the keys whose posting sets gain or lose the relation, to
+        # change each set once.  Relations without values are kept by name.
+        if tokens is None:
+            changes.setdefault(None, {}).setdefault(name, []).append(relToken)
+        else:
+            keys = changes.setdefault(name, {})
+            for key in tokens:
+                keys.setdefault(key, []).append(relToken)
+
+    def _getDataset(self, name):
+        if name is None:
+            return self._EMPTY_name_TO_relcount_relset
+        return self._name_TO_mapping[name]
+
+    def _addMany(self, changes):
+        for name, keys in changes.items():
+            dataset = self._getDataset(name)
+            for key in sorted(keys):
+                self._addRelations(dataset, key, keys[key])
+
+    def _removeMany(self, changes):
+        for name, keys in changes.items():
+            dataset = self._getDataset(name)
+            for key in sorted(keys):
+                self._removeRelations(dataset, key, keys[key])
 
     # Tokenization
     # ============
@@ -741,15 +1918,21 @@ class Catalog(persistent.Persistent):
     # Internal Helpers
     # ----------------
 
-    def _relData(self, query):
+    def _relData(self, query, steps=None):
         # query must be BTrees.family32.OO.Bucket.  The key may be
         # a value index name or RELATION, indicating one or more relations. The
         # val may be token, None, or iterator (object with a `next` method) of
-        # tokens (may not include None).
+        # tokens (may not include None).  If steps is a list, (name, length,
+        # action, count) tuples for the terms are appended to it (see
+        # ``explain``).
         if not query:
             return self._relTokens
-        data = []
         tools = self._relTools
+        # each term of the query is the sets of relations of its tokens, and
+        # their total length: the term's length, or, for ``any`` of several
+        # tokens of a value index, an upper bound.  The lengths come from
+        # the counts kept for the tokens, so no union is built to learn them.
+        terms = []
         explicit_relations = False
         for name, value in query.items():
             if name is RELATION:
@@ -758,68 +1941,148 @@ class Catalog(persistent.Persistent):
                     value = (value,)
                 rels = tools['Set'](value)
                 length = len(rels)
+                sets = (rels,)
+            elif isinstance(value, Any):
+                get = self._name_TO_mapping[name].get
+                length = 0
+                sets = []
+                for token in value:
+                    count, rels = self._getRelations(get(token))
+                    if count:
+                        length += count
+                        sets.append(rels)
             else:
-                if isinstance(value, Any):
-                    get = self._name_TO_mapping[name].get
-                    rels = multiunion(
-                        (get(token, (None, None))[1] for token in value),
-                        self._relTools)
-                    length = len(rels)
+                if value is None:
+                    relData = self._EMPTY_name_TO_relcount_relset.get(name)
                 else:
-                    if value is None:
-                        relData = self._EMPTY_name_TO_relcount_relset.get(name)
-                    else:
-                        relData = self._name_TO_mapping[name].get(value)
-                    if relData is None:
-                        return None
-                    length = relData[0].value
-                    rels = relData[1]
+                    relData = self._name_TO_mapping[name].get(value)
+                length, rels = self._getRelations(relData)
+                sets = (rels,)
             if not length:
+                if steps is not None:
+                    steps.append((name, 0, 'empty', 0))
                 return None
-            data.append((length, rels))
+            terms.append((length, sets, name))
+        if explicit_relations and len(terms) == 1:
+            # we'll need to make sure the relations are actually members.
+            # (The relations of a value token always are.)
+            terms.append((self._relLength.value, (self._relTokens,), RELATION))
         # we don't want to sort on the set values!! just the lengths.
-        data.sort(key=lambda i: i[0])
-        if explicit_relations and len(data) == 1:
-            # we'll need to intersect with our set of relations to make
-            # sure the relations are actually members.  This set should
-            # be the biggest possible set, so we put it at the end after
-            # sorting.
-            data.append((self._relLength.value, self._relTokens))
-        # we know we have at least one result now.  intersect all.  Work
-        # from smallest to largest, until we're done or we don't have any
-        # more results.
-        res = data.pop(0)[1]
-        while res and data:
-            res = self._relTools['intersection'](res, data.pop(0)[1])
+        terms.sort(key=lambda i: i[0])
+        # we know we have at least one result now.  Work from the smallest
+        # term to the largest, until we're done or we don't have any more
+        # results.  A small result is checked against the sets of a larger
+        # term, rather than intersected with them, or with their union.
+        count, sets, name = terms[0]
+        if len(sets) > 1:
+            res = multiunion(sets, tools)
+            if steps is not None:
+                steps.append((name, count, 'union', len(res)))
+            count = len(res)
+        else:
+            res = sets[0]  # a TreeSet may have to count its buckets: use ours
+            if steps is not None:
+                steps.append((name, count, 'first', count))
+        for length, sets, name in terms[1:]:
+            if not count:
+                break
+            if count * len(sets) * _PROBE_COST < length:
+                res = tools['Set'](_probe(res, sets))
+                action = 'probe'
+            elif len(sets) > 1:
+                res = tools['intersection'](res, multiunion(sets, tools))
+                action = 'intersect'
+            else:
+                res = tools['intersection'](res, sets[0])
+                action = 'intersect'
+            count = len(res)
+            if steps is not None:
+                steps.append((name, length, action, count))
         return res
 
-    def _getSearchIndexResults(self, key, query, maxDepth, filter,
-                               targetQuery, targetFilter, queryFactory):
-        # only call for relations
-        for (c_filter, c_queryFactory,
-             c_static_values, ix) in self._searchIndexMatches.get(key, ()):
-            if (c_filter != filter or
-                    c_queryFactory != queryFactory):
-                continue
+    def _getSearchIndexKey(self, name, query, maxDepth):
+        # the key of _searchIndexMatches for a search for relations (with no
+        # name), or for values of a name.
+        if RELATION in query:
+            relation_query = True
+            query_names = tuple(nm for nm in query if nm is not RELATION)
+        else:
+            relation_query = False
+            query_names = tuple(query)
+        return (name is None, name or '', relation_query, query_names,
+                maxDepth or 0)
+
+    def _getSearchIndexMatches(self, name, query, maxDepth, filter,
+                               queryFactory, report=None):
+        # the static values and search indexes that may have the results of
+        # a search (see _getSearchIndexKey)
+        key = self._getSearchIndexKey(name, query, maxDepth)
+        matches = self._searchIndexMatches.get(key, ())
+        if not matches:
+            _reportSearchIndex(report, key, None, 'no search index')
+        res = []
+        for c_filter, c_queryFactory, c_static_values, ix in matches:
+            if c_filter != filter:
+                _reportSearchIndex(report, key, ix, 'filter')
+            elif c_queryFactory != queryFactory:
+                _reportSearchIndex(report, key, ix, 'queryFactory')
+            else:
+                res.append((c_static_values, ix))
+        return res
+
+    def _getSearchIndexResults(self, matches, name, query, maxDepth, filter,
+                               queryFactory, report=None):
+        for c_static_values, ix in matches:
             for k, v in c_static_values:
                 if query[k] != v:  # we want a precise match here
-                    continue
-            res = ix.getResults(
-                None, query, maxDepth, filter, queryFactory)
-            if res is not None:
-                if res:
-                    if targetQuery:
-                        targetData = self._relData(targetQuery)
-                        if not targetData:
-                            return self._relTools['Set']()
-                        res = self._relTools['intersection'](
-                            res, targetData)
-                    if targetFilter is not None:
-                        targetCache = {}
-                        res = (rel
-                               for rel in res
-                               if targetFilter(
-                                   [rel], query, self, targetCache))
+                    reason = 'static'
+                    break
+            else:
+                res = ix.getResults(
+                    name, query, maxDepth, filter, queryFactory)
+                reason = 'declined' if res is None else 'used'
+            if report is not None:
+                _reportSearchIndex(
+                    report, self._getSearchIndexKey(name, query, maxDepth),
+                    ix, reason)
+            if reason == 'used':
+                return res
+
+    def _getTargetResults(self, res, query, targetQuery, targetFilter,
+                          report=None):
+        # the relations of search index results that match the targets
+        if targetQuery:
+            targetData = self._relData(
+                targetQuery, _steps(report, 'targetRelData'))
+            if not targetData:
+                return self._relTools['Set']()
+            res = self._relTools['intersection'](res, targetData)
+        if targetFilter is not None:
+            targetCache = {}
+            res = (rel for rel in res
+                   if targetFilter([rel], query, self, targetCache))
+        return res
+
+    def _getSearchIndexReach(self, matches, query, maxDepth, filter,
+                             targetQuery, queryFactory, report=None):
+        # ask the search indexes that can answer ``canFind`` directly
+        for c_static_values, ix in matches:
+            if not interfaces.IReachabilitySearchIndex.providedBy(ix):
+                reason = 'not reachability'
+            else:
+                for k, v in c_static_values:
+                    if query[k] != v:  # we want a precise match here
+                        reason = 'static'
+                        break
+                else:
+                    res = ix.canFind(
+                        query, targetQuery, maxDepth, filter, queryFactory)
+                    reason = 'declined' if res is None else 'used'
+            if report is not None:
+                _reportSearchIndex(
+                    report, self._getSearchIndexKey(None, query, maxDepth),
+                    ix, reason)
+            if reason == 'used':
                 return res
 
     def _iterListeners(self):
@@ -843,14 +2106,12 @@ class Catalog(persistent.Persistent):
         return queryFactory, res
 
     def _parse(self, query, maxDepth, filter, targetQuery, targetFilter,
-               getQueries):
+               getQueries, report=None):
         assert (isinstance(query, BTrees.family32.OO.Bucket) and
                 isinstance(targetQuery, BTrees.family32.OO.Bucket)), (
                     'internal error: parse expects query and targetQuery '
                     'to already be normalized (to OO.Bucket.')
-        if maxDepth is not None and (
-                not isinstance(maxDepth, int) or maxDepth < 1):
-            raise ValueError('maxDepth must be None or a positive integer')
+        _checkMaxDepth(maxDepth)
         if getQueries is not None:
             queries = getQueries(())
         else:
@@ -858,17 +2119,22 @@ class Catalog(persistent.Persistent):
         if getQueries is None and maxDepth is not None:
             raise ValueError(
                 'if maxDepth not in (None, 1), queryFactory must be available')
-        relData = (r for r in (self._relData(q) for q in queries) if r)
+        relData = (r for r in (self._relData(q, _steps(report, 'relData'))
+                               for q in queries) if r)
         if filter is not None:
             filterCache = {}
 
             def checkFilter(relchain, query):
                 return filter(relchain, query, self, filterCache)
+            if interfaces.IPathIndependentFilter.providedBy(filter):
+                zope.interface.directlyProvides(
+                    checkFilter, interfaces.IPathIndependentFilter)
         else:
             checkFilter = None
         targetCache = {}
         if targetQuery:
-            targetData = self._relData(targetQuery)
+            targetData = self._relData(
+                targetQuery, _steps(report, 'targetRelData'))
             if not targetData:
                 relData = ()  # shortcut
                 checkTargetFilter = None
@@ -885,9 +2151,235 @@ class Catalog(persistent.Persistent):
                 return targetFilter(relchain, query, self, targetCache)
         else:
             checkTargetFilter = None
+        if checkTargetFilter is not None and (
+                targetFilter is None or
+                interfaces.IPathIndependentFilter.providedBy(targetFilter)):
+            zope.interface.directlyProvides(
+                checkTargetFilter, interfaces.IPathIndependentFilter)
         return (query, relData, maxDepth, checkFilter, checkTargetFilter,
                 getQueries)
 
+    def _getTransposition(self, query, filter, targetFilter, queryFactory,
+                          getQueries):
+        # if the search can be done a level at a time, return the
+        # transposition of the query factory.
+        # A subclass that overrides ``__call__`` but not ``getTransposition``
+        # may no longer walk as the transposition says, so it is called.
+        if (filter is None and targetFilter is None and
+                getQueries is not None and
+                interfaces.ITransposingQueryFactory.providedBy(queryFactory)):
+            for cls in type(queryFactory).__mro__:
+                if '__call__' in cls.__dict__:
+                    if 'getTransposition' in cls.__dict__:
+                        return queryFactory.getTransposition(query)
+                    return None
+
+    def _transposingStep(self, rels, fromName, toName):
+        # return the relations with ``toName`` values that are ``fromName``
+        # values of ``rels``.  RELATION (None) as a name means the relation
+        # tokens themselves.
+        tools = self._relTools
+        if fromName is None:
+            tokens = rels
+        else:
+            tokens = self._unionTokens(rels, fromName)
+        if toName is None:
+            if fromName is None:
+                return rels
+            return tools['intersection'](tools['Set'](tokens), self._relTokens)
+        get = self._name_TO_mapping[toName].get
+        return multiunion(
+            (self._getRelations(get(t))[1] for t in tokens), tools)
+
+    def _yieldTransposedLevels(self, query, transposition, maxDepth,
+                               report=None):
+        # a breadth-first search a level at a time, yielding the set of
+        # relations first found at each depth.  The work is done with BTree
+        # set operations: each level is the union of the relations one step
+        # from the last level, less the relations already found.
+        name, other, static = transposition
+        tools = self._relTools
+        if static:
+            staticData = self._relData(BTrees.family32.OO.Bucket(static))
+        else:
+            staticData = self._relTokens
+        level = self._relData(query, _steps(report, 'relData'))
+        found = tools['TreeSet']()
+        depth = 1
+        while level:
+            if report is not None:
+                report['levels'].append(len(level))
+            yield level
+            if not staticData or maxDepth is not None and depth >= maxDepth:
+                break
+            found.update(level)
+            level = self._transposingStep(level, other, name)
+            if level and static:
+                level = tools['intersection'](level, staticData)
+            if level:
+                level = tools['difference'](level, found)
+            depth += 1
+
+    def _findTransposed(self, query, transposition, maxDepth, targetQuery,
+                        report=None):
+        tools = self._relTools
+        res = multiunion(
+            self._yieldTransposedLevels(
+                query, transposition, maxDepth, report), tools)
+        if targetQuery and res:
+            targetData = self._relData(
+                targetQuery, _steps(report, 'targetRelData'))
+            if not targetData:
+                return tools['Set']()
+            res = tools['intersection'](res, targetData)
+        return res
+
+    def _canFindTransposed(self, query, transposition, maxDepth,
+                           targetQuery, report=None):
+        # a bidirectional search: walk forward a level at a time from the
+        # query, and backward (transposing the other way) from the targets,
+        # always expanding the smaller frontier, until the two meet.
+        name, other, static = transposition
+        tools = self._relTools
+        forward = self._relData(query, _steps(report, 'relData'))
+        backward = self._relData(targetQuery, _steps(report, 'targetRelData'))
+        if not forward or not backward:
+            return False
+        if tools['intersection'](forward, backward):
+            return True
+        if static:
+            staticData = self._relData(BTrees.family32.OO.Bucket(static))
+            if not staticData:
+                return False
+            backward = tools['intersection'](backward, staticData)
+        forwardFound = tools['TreeSet']()
+        forwardFound.update(forward)
+        backwardFound = tools['TreeSet']()
+        backwardFound.update(backward)
+        # the length of the longest chain that the found sets can join
+        depth = 1
+        while forward and backward:
+            if maxDepth is not None and depth >= maxDepth:
+                break
+            depth += 1
+            if len(forward) <= len(backward):
+                level = self._transposingStep(forward, other, name)
+                found, otherFound = forwardFound, backwardFound
+            else:
+                level = self._transposingStep(backward, name, other)
+                found, otherFound = backwardFound, forwardFound
+            if level and static:
+                level = tools['intersection'](level, staticData)
+            if level:
+                level = tools['difference'](level, found)
+            if level:
+                if tools['intersection'](level, otherFound):
+                    return True
+                found.update(level)
+            if found is forwardFound:
+                forward = level
+            else:
+                backward = level
+        return False
+
+    def _yieldFoundChains(self, query, relData, maxDepth, checkFilter,
+                          checkTargetFilter, getQueries, report=None):
+        # for the searches that only want the relations found, not the paths
+        # to them: if the filters and the query factory allow it, visit each
+        # relation only once.
+        shortest = (_isPathIndependent(checkFilter) and
+                    _isPathIndependent(checkTargetFilter) and
+                    _isPathIndependentQueries(getQueries))
+        if report is not None and getQueries is not None:
+            # count the chains that are expanded (given to the query
+            # factory)
+            def countingGetQueries(relchain, getQueries=getQueries):
+                if relchain:
+                    report['expanded'] += 1
+                return getQueries(relchain)
+            getQueries = countingGetQueries
+        if shortest:
+            res = self._yieldShortestChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries)
+        else:
+            res = self._yieldChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries, False)
+        if report is not None:
+            res = _countChains(res, report)
+        return res
+
+    def _yieldDepths(self, query, maxDepth, filter, targetQuery,
+                     targetFilter, queryFactory, getQueries, report=None):
+        # yield (depth, set of relation tokens) pairs, in order of depth.
+        # Each set holds the relations first found at that depth, so the
+        # sets are disjoint.
+        tools = self._relTools
+        if getQueries is None and maxDepth == 1:
+            maxDepth = None  # an intransitive search
+        transposition = self._getTransposition(
+            query, filter, targetFilter, queryFactory, getQueries)
+        if report is not None:
+            report['path'] = (
+                'traversal' if transposition is None else 'transposed')
+        if transposition is not None:
+            _checkMaxDepth(maxDepth)
+            levels = self._yieldTransposedLevels(
+                query, transposition, maxDepth, report)
+            if targetQuery:
+                targetData = self._relData(
+                    targetQuery, _steps(report, 'targetRelData'))
+                if not targetData:
+                    return
+                levels = (tools['intersection'](level, targetData)
+                          for level in levels)
+            for depth, level in enumerate(levels, 1):
+                if level:
+                    yield depth, level
+            return
+        # the chains come breadth first, so they are in order of length, and
+        # the first chain to a relation is one of the shortest.
+        seen = set()
+        level = []
+        depth = 0
+        for chain in self._yieldFoundChains(*self._parse(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                getQueries, report), report=report):
+            relToken = chain[-1]
+            if relToken in seen:
+                continue
+            seen.add(relToken)
+            if len(chain) != depth:
+                if level:
+                    yield depth, tools['Set'](level)
+                depth = len(chain)
+                level = []
+            level.append(relToken)
+        if level:
+            yield depth, tools['Set'](level)
+
+    def _yieldValueDepths(self, name, depths):
+        # convert the relation depths to value depths: a value is at the
+        # depth of the first relation that has it.
+        data = self._attrs[name]
+        found = data['TreeSet']()
+        for depth, rels in depths:
+            values = self._unionTokens(rels, name)
+            if values:
+                values = data['difference'](values, found)
+            if values:
+                found.update(values)
+                yield depth, values
+
+    def _getDepthResults(self, depths, minDepth, byDepth, data):
+        if minDepth is not None:
+            depths = ((depth, res) for depth, res in depths
+                      if depth >= minDepth)
+        if byDepth:
+            return dict(depths)
+        return multiunion((res for depth, res in depths), data)
+
     # API to help plugin writers
     # --------------------------
 
@@ -909,54 +2401,126 @@ class Catalog(persistent.Persistent):
         if reltoken is None:
             return self._name_TO_mapping[name]
         else:
-            return self._reltoken_name_TO_objtokenset.get(
-                (reltoken, name))
+            return self._getTokens(reltoken, name)
 
     def yieldRelationTokenChains(self, query, relData, maxDepth, checkFilter,
                                  checkTargetFilter, getQueries,
                                  findCycles=True):
-        stack = []
-        for d in relData:
-            stack.append(((), iter(d)))
-        while stack:
-            tokenChain, relDataIter = stack[0]
+        for chain in self._yieldChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries, findCycles):
+            if isinstance(chain, _Chain):
+                chain = chain.tuple()
+            yield chain
+
+    def _yieldChains(self, query, relData, maxDepth, checkFilter,
+                     checkTargetFilter, getQueries, findCycles):
+        # Yields _Chain instances, or CircularRelationPath instances for the
+        # cycles.  The queue holds iterators of the relation tokens that
+        # extend a chain (or that start chains, with None), and is worked
+        # breadth first.
+        queue = collections.deque((None, iter(d)) for d in relData)
+        while queue:
+            parent, relDataIter = queue[0]
             relToken = next(relDataIter, _marker)
             if relToken is _marker:
-                stack.pop(0)
+                queue.popleft()
+                continue
+            chain = _Chain(relToken, parent)
+            if checkFilter is not None and not checkFilter(chain, query):
+                continue
+            walkFurther = maxDepth is None or chain.length < maxDepth
+            cycled = None
+            if getQueries is not None and (walkFurther or findCycles):
+                _next = set()
+                cycled = []
+                for q in getQueries(chain):
+                    relData = self._relData(q)
+                    if relData:
+                        if chain.intersects(relData):
+                            # it's a cycle
+                            cycled.append(q)
+                        elif walkFurther:
+                            _next.update(relData)
+                if walkFurther and _next:
+                    queue.append((chain, iter(_next)))
+            if cycled:
+                res = CircularRelationPath(chain.tuple(), cycled)
             else:
-                tokenChain += (relToken,)
-                if checkFilter is not None and not checkFilter(
-                        tokenChain, query):
-                    continue
-                walkFurther = maxDepth is None or len(tokenChain) < maxDepth
-                if getQueries is not None and (walkFurther or findCycles):
-                    oldInputs = frozenset(tokenChain)
-                    _next = set()
-                    cycled = []
-                    for q in getQueries(tokenChain):
-                        relData = self._relData(q)
-                        if relData:
-                            intersection = oldInputs.intersection(relData)
-                            if intersection:
-                                # it's a cycle
-                                cycled.append(q)
-                            elif walkFurther:
-                                _next.update(relData)
-                    if walkFurther and _next:
-                        stack.append((tokenChain, iter(_next)))
-                    if cycled:
-                        tokenChain = CircularRelationPath(
-                            tokenChain, cycled)
-                if (checkTargetFilter is None or
-                        checkTargetFilter(tokenChain, query)):
-                    yield tokenChain
+                res = chain
+            if checkTargetFilter is None or checkTargetFilter(res, query):
+                yield res
+
+    def yieldShortestRelationTokenChains(self, query, relData, maxDepth,
+                                         checkFilter, checkTargetFilter,
+                                         getQueries):
+        for chain in self._yieldShortestChains(
+                query, relData, maxDepth, checkFilter, checkTargetFilter,
+                getQueries):
+            yield chain.tuple()
+
+    def _yieldShortestChains(self, query, relData, maxDepth, checkFilter,
+                             checkTargetFilter, getQueries):
+        # Yields _Chain instances.  Like yieldRelationTokenChains, but each
+        # relation token is expanded at most once, by the first chain that
+        # reaches it.  The queue is worked breadth first, so the chains are in
+        # order of length and the first chain to a token is one of the
+        # shortest: the depth we honor for ``maxDepth`` is the shortest depth
+        # of the token.  This is only equivalent to walking every path when
+        # the filters, if any, provide IPathIndependentFilter, and getQueries,
+        # if any, provides IPathIndependentQueries.  Cycles are simply not
+        # walked again, so they are not reported.
+        seen = set()
+        queue = collections.deque((None, iter(d)) for d in relData)
+        while queue:
+            parent, relDataIter = queue[0]
+            relToken = next(relDataIter, _marker)
+            if relToken is _marker:
+                queue.popleft()
+                continue
+            if relToken in seen:
+                continue
+            seen.add(relToken)
+            chain = _Chain(relToken, parent)
+            if checkFilter is not None and not checkFilter(chain, query):
+                continue
+            if getQueries is not None and (
+                    maxDepth is None or chain.length < maxDepth):
+                _next = set()
+                for q in getQueries(chain):
+                    relData = self._relData(q)
+                    if relData:
+                        _next.update(relData)
+                _next.difference_update(seen)
+                if _next:
+                    queue.append((chain, iter(_next)))
+            if (checkTargetFilter is None or
+                    checkTargetFilter(chain, query)):
+                yield chain
 
     # Main search API
     # ---------------
 
+    def prepare(self, name=None, queryNames=(), maxDepth=None, filter=None,
+                targetNames=(), targetFilter=None, queryFactory=None,
+                ignoreSearchIndex=False):
+        return PreparedQuery(
+            self, name, queryNames, maxDepth, filter, targetNames,
+            targetFilter, queryFactory, ignoreSearchIndex)
+
     def findValueTokens(self, name, query=(), maxDepth=None,
                         filter=None, targetQuery=(), targetFilter=None,
-                        queryFactory=None, ignoreSearchIndex=False):
+                        queryFactory=None, ignoreSearchIndex=False,
+                        minDepth=None, byDepth=False):
+        return self._searchValueTokens(
+            name, query, maxDepth, filter, targetQuery, targetFilter,
+            queryFactory, ignoreSearchIndex, minDepth, byDepth)
+
+    def _searchValueTokens(self, name, query, maxDepth, filter, targetQuery,
+                           targetFilter, queryFactory, ignoreSearchIndex,
+                           minDepth, byDepth, report=None):
+        # findValueTokens, recording how the search is done in ``report``,
+        # if any (see explain)
         data = self._attrs.get(name)
         if data is None:
             raise ValueError('name not indexed', name)
@@ -965,77 +2529,110 @@ class Catalog(persistent.Persistent):
         if queryFactory is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
+        _report(report, 'queryFactory', queryFactory)
         targetQuery = BTrees.family32.OO.Bucket(targetQuery)
+        if minDepth is not None or byDepth:
+            _checkMinDepth(minDepth)
+            if getQueries is None:
+                queryFactory, getQueries = self._getQueryFactory(
+                    query, queryFactory)
+                _report(report, 'queryFactory', queryFactory)
+            depths = self._yieldDepths(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                queryFactory, getQueries, report)
+            return self._getDepthResults(
+                self._yieldValueDepths(name, depths), minDepth, byDepth,
+                data)
+        return self._findValueTokens(
+            name, data, query, maxDepth, filter, targetQuery, targetFilter,
+            queryFactory, getQueries,
+            self._getSearchIndexMatcher(ignoreSearchIndex, report), report)
+
+    def _getSearchIndexMatcher(self, ignoreSearchIndex, report):
+        # the ``getMatches`` of the searches below
+        if ignoreSearchIndex:
+            return None
+        if report is not None:
+            return functools.partial(
+                self._getSearchIndexMatches, report=report)
+        return self._getSearchIndexMatches
+
+    def _findValueTokens(self, name, data, query, maxDepth, filter,
+                         targetQuery, targetFilter, queryFactory, getQueries,
+                         getMatches, report=None):
+        # findValueTokens, for a normalized query.  ``getMatches`` returns
+        # the search indexes to ask (see _getSearchIndexMatches), or is None
+        # to ignore them.
         if (((maxDepth is None and queryFactory is None)
              or maxDepth == 1) and filter is None and targetFilter is None):
             # return a set
+            _report(report, 'path', 'direct')
             if not query and not targetQuery:
-                return self._name_TO_mapping[name]
-            rels = self._relData(query)
+                return self.getValueTokens(name)
+            rels = self._relData(query, _steps(report, 'relData'))
             if targetQuery and rels:
                 # well, it's kind of odd to have specified query and
                 # targetQuery without a transitive search, but hey, this
                 # should be the result.
                 rels = self._relTools['intersection'](
-                    rels, self._relData(targetQuery))
+                    rels, self._relData(
+                        targetQuery, _steps(report, 'targetRelData')))
             if not rels:
                 return data['Set']()
             elif len(rels) == 1:
-                res = self._reltoken_name_TO_objtokenset.get(
-                    (rels.maxKey(), name))
+                res = self._getTokens(rels.maxKey(), name)
                 if res is None:
                     res = self._attrs[name]['Set']()
                 return res
             else:
-                return multiunion(
-                    (self._reltoken_name_TO_objtokenset.get((r, name))
-                     for r in rels), data)
-        if not ignoreSearchIndex and self._searchIndexMatches is not None:
-            if RELATION in query:
-                relation_query = True
-                query_names = tuple(nm for nm in query if nm is not RELATION)
-            else:
-                relation_query = False
-                query_names = tuple(query)
+                return self._unionTokens(rels, name)
+        if getMatches is not None and self._searchIndexMatches is not None:
+            self.updateSearchIndexes()
             if not targetQuery and targetFilter is None:
-                key = (False, name, relation_query, query_names, maxDepth or 0)
-                for (c_filter,
-                     c_queryFactory,
-                     c_static_values,
-                     ix) in self._searchIndexMatches.get(key, ()):
-                    if (c_filter != filter or
-                            c_queryFactory != queryFactory):
-                        continue
-                    for k, v in c_static_values:
-                        if query[k] != v:
-                            continue
-                    res = ix.getResults(
-                        name, query, maxDepth, filter, queryFactory)
-                    if res is not None:
-                        return res
-            key = (True, '', relation_query, query_names, maxDepth or 0)
+                res = self._getSearchIndexResults(
+                    getMatches(name, query, maxDepth, filter, queryFactory),
+                    name, query, maxDepth, filter, queryFactory, report)
+                if res is not None:
+                    return res
             res = self._getSearchIndexResults(
-                key, query, maxDepth, filter, targetQuery, targetFilter,
-                queryFactory)
+                getMatches(None, query, maxDepth, filter, queryFactory),
+                None, query, maxDepth, filter, queryFactory, report)
             if res is not None:
-                return multiunion(
-                    (self._reltoken_name_TO_objtokenset.get((r, name))
-                     for r in res),
-                    self._attrs[name])
+                if res:
+                    res = self._getTargetResults(
+                        res, query, targetQuery, targetFilter, report)
+                return self._unionTokens(res, name)
         if getQueries is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
+            _report(report, 'queryFactory', queryFactory)
+        transposition = self._getTransposition(
+            query, filter, targetFilter, queryFactory, getQueries)
+        if transposition is not None:
+            _checkMaxDepth(maxDepth)
+            _report(report, 'path', 'transposed')
+            rels = self._findTransposed(
+                query, transposition, maxDepth, targetQuery, report)
+            return self._unionTokens(rels, name)
+        _report(report, 'path', 'traversal')
         return self._yieldValueTokens(
             name, *self._parse(  # query and targetQuery normalized above
                 query, maxDepth, filter, targetQuery, targetFilter,
-                getQueries))
+                getQueries, report), report=report)
 
     def findValues(self, name, query=(), maxDepth=None, filter=None,
                    targetQuery=(), targetFilter=None,
-                   queryFactory=None, ignoreSearchIndex=False):
-        res = self.findValueTokens(name, query, maxDepth, filter,
-                                   targetQuery, targetFilter,
-                                   queryFactory, ignoreSearchIndex)
+                   queryFactory=None, ignoreSearchIndex=False,
+                   minDepth=None):
+        if minDepth is None:  # subclasses may not know about minDepth
+            res = self.findValueTokens(name, query, maxDepth, filter,
+                                       targetQuery, targetFilter,
+                                       queryFactory, ignoreSearchIndex)
+        else:
+            res = self.findValueTokens(name, query, maxDepth, filter,
+                                       targetQuery, targetFilter,
+                                       queryFactory, ignoreSearchIndex,
+                                       minDepth=minDepth)
         resolve = self._attrs[name]['load']
         if resolve is None:
             return res
@@ -1045,19 +2642,18 @@ class Catalog(persistent.Persistent):
 
     def _yieldValueTokens(
             self, name, query, relData, maxDepth, checkFilter,
-            checkTargetFilter, getQueries, yieldSets=False):
+            checkTargetFilter, getQueries, yieldSets=False, report=None):
         # this is really an internal bit of findValueTokens, and is only
         # used there.
         relSeen = set()
         objSeen = set()
-        for path in self.yieldRelationTokenChains(
+        for path in self._yieldFoundChains(
                 query, relData, maxDepth, checkFilter, checkTargetFilter,
-                getQueries, findCycles=False):
+                getQueries, report):
             relToken = path[-1]
             if relToken not in relSeen:
                 relSeen.add(relToken)
-                outputSet = self._reltoken_name_TO_objtokenset.get(
-                    (relToken, name))
+                outputSet = self._getTokens(relToken, name)
                 if outputSet:
                     if yieldSets:  # this is needed for zc.relationship!!!
                         yield outputSet
@@ -1069,54 +2665,96 @@ class Catalog(persistent.Persistent):
 
     def findRelationTokens(self, query=(), maxDepth=None, filter=None,
                            targetQuery=(), targetFilter=None,
-                           queryFactory=None, ignoreSearchIndex=False):
+                           queryFactory=None, ignoreSearchIndex=False,
+                           minDepth=None, byDepth=False):
+        return self._searchRelationTokens(
+            query, maxDepth, filter, targetQuery, targetFilter, queryFactory,
+            ignoreSearchIndex, minDepth, byDepth)
+
+    def _searchRelationTokens(self, query, maxDepth, filter, targetQuery,
+                              targetFilter, queryFactory, ignoreSearchIndex,
+                              minDepth, byDepth, report=None):
+        # findRelationTokens; see _searchValueTokens
         query = BTrees.family32.OO.Bucket(query)  # sorts on key
         getQueries = None
         if queryFactory is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
+        _report(report, 'queryFactory', queryFactory)
         targetQuery = BTrees.family32.OO.Bucket(targetQuery)
+        if minDepth is not None or byDepth:
+            _checkMinDepth(minDepth)
+            if getQueries is None:
+                queryFactory, getQueries = self._getQueryFactory(
+                    query, queryFactory)
+                _report(report, 'queryFactory', queryFactory)
+            return self._getDepthResults(
+                self._yieldDepths(
+                    query, maxDepth, filter, targetQuery, targetFilter,
+                    queryFactory, getQueries, report),
+                minDepth, byDepth, self._relTools)
+        return self._findRelationTokens(
+            query, maxDepth, filter, targetQuery, targetFilter,
+            queryFactory, getQueries,
+            self._getSearchIndexMatcher(ignoreSearchIndex, report), report)
+
+    def _findRelationTokens(self, query, maxDepth, filter, targetQuery,
+                            targetFilter, queryFactory, getQueries,
+                            getMatches, report=None):
+        # findRelationTokens, for a normalized query; see _findValueTokens
         if (((maxDepth is None and queryFactory is None)
                 or maxDepth == 1)
                 and filter is None
                 and not targetQuery
                 and targetFilter is None):
-            res = self._relData(query)
+            _report(report, 'path', 'direct')
+            res = self._relData(query, _steps(report, 'relData'))
             if res is None:
                 res = self._relTools['Set']()
             return res
-        if not ignoreSearchIndex and self._searchIndexMatches is not None:
-            if RELATION in query:
-                relation_query = True
-                query_names = tuple(nm for nm in query if nm is not None)
-            else:
-                relation_query = False
-                query_names = tuple(query)
-            key = (True, '', relation_query, query_names, maxDepth or 0)
+        if getMatches is not None and self._searchIndexMatches is not None:
+            self.updateSearchIndexes()
             res = self._getSearchIndexResults(
-                key, query, maxDepth, filter, targetQuery, targetFilter,
-                queryFactory)
+                getMatches(None, query, maxDepth, filter, queryFactory),
+                None, query, maxDepth, filter, queryFactory, report)
             if res is not None:
+                if res:
+                    res = self._getTargetResults(
+                        res, query, targetQuery, targetFilter, report)
                 return res
         if getQueries is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
+            _report(report, 'queryFactory', queryFactory)
+        transposition = self._getTransposition(
+            query, filter, targetFilter, queryFactory, getQueries)
+        if transposition is not None:
+            _checkMaxDepth(maxDepth)
+            _report(report, 'path', 'transposed')
+            return self._findTransposed(
+                query, transposition, maxDepth, targetQuery, report)
+        _report(report, 'path', 'traversal')
         seen = self._relTools['Set']()
         return (res[-1]
-                for res in self.yieldRelationTokenChains(
+                for res in self._yieldFoundChains(
                     *self._parse(
                         query, maxDepth, filter, targetQuery,
-                        targetFilter, getQueries) +
-                    (False,))
+                        targetFilter, getQueries, report), report=report)
                 if seen.insert(res[-1]))
 
     def findRelations(self, query=(), maxDepth=None, filter=None,
                       targetQuery=(), targetFilter=None,
-                      queryFactory=None, ignoreSearchIndex=False):
-        return self.resolveRelationTokens(
-            self.findRelationTokens(
+                      queryFactory=None, ignoreSearchIndex=False,
+                      minDepth=None):
+        if minDepth is None:  # subclasses may not know about minDepth
+            res = self.findRelationTokens(
                 query, maxDepth, filter, targetQuery, targetFilter,
-                queryFactory, ignoreSearchIndex))
+                queryFactory, ignoreSearchIndex)
+        else:
+            res = self.findRelationTokens(
+                query, maxDepth, filter, targetQuery, targetFilter,
+                queryFactory, ignoreSearchIndex, minDepth=minDepth)
+        return self.resolveRelationTokens(res)
 
     def findRelationChains(self, query, maxDepth=None, filter=None,
                            targetQuery=(), targetFilter=None,
@@ -1154,38 +2792,127 @@ class Catalog(persistent.Persistent):
             query, maxDepth, filter, BTrees.family32.OO.Bucket(targetQuery),
             targetFilter, getQueries))
 
+    def findShortestRelationTokenChain(self, query, targetQuery,
+                                       maxDepth=None, filter=None,
+                                       queryFactory=None):
+        query = BTrees.family32.OO.Bucket(query)  # sorts on key
+        queryFactory, getQueries = self._getQueryFactory(
+            query, queryFactory)
+        args = self._parse(
+            query, maxDepth, filter, BTrees.family32.OO.Bucket(targetQuery),
+            None, getQueries)
+        # both engines walk breadth first, so the first chain to a target is
+        # one of the shortest.  If the filter and the query factory allow it,
+        # each relation is expanded only once, by the first chain to reach it.
+        if _isPathIndependent(args[3]) and _isPathIndependentQueries(args[5]):
+            chain = next(self._yieldShortestChains(*args), None)
+        else:
+            chain = next(self._yieldChains(*(args + (False,))), None)
+        if isinstance(chain, _Chain):
+            chain = chain.tuple()
+        elif chain is not None:
+            chain = tuple(chain)  # cycles are not reported, as in _Chains
+        return chain
+
+    def findShortestRelationChain(self, query, targetQuery, maxDepth=None,
+                                  filter=None, queryFactory=None):
+        chain = self.findShortestRelationTokenChain(
+            query, targetQuery, maxDepth, filter, queryFactory)
+        if chain is not None:
+            resolve = self._relTools['load']
+            cache = {}
+            chain = tuple(resolve(t, self, cache) for t in chain)
+        return chain
+
     def canFind(self, query, maxDepth=None, filter=None,
                 targetQuery=(), targetFilter=None,
                 queryFactory=None, ignoreSearchIndex=False):
+        return self._searchCanFind(
+            query, maxDepth, filter, targetQuery, targetFilter, queryFactory,
+            ignoreSearchIndex)
+
+    def _searchCanFind(self, query, maxDepth, filter, targetQuery,
+                       targetFilter, queryFactory, ignoreSearchIndex,
+                       report=None):
+        # canFind; see _searchValueTokens
         query = BTrees.family32.OO.Bucket(query)  # sorts on key
         getQueries = None
         if queryFactory is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
+        _report(report, 'queryFactory', queryFactory)
         targetQuery = BTrees.family32.OO.Bucket(targetQuery)
-        if not ignoreSearchIndex and self._searchIndexMatches is not None:
-            if RELATION in query:
-                relation_query = True
-                query_names = tuple(nm for nm in query if nm is not None)
-            else:
-                relation_query = False
-                query_names = tuple(query)
-            key = (True, '', relation_query, query_names, maxDepth or 0)
+        return self._canFind(
+            query, maxDepth, filter, targetQuery, targetFilter,
+            queryFactory, getQueries,
+            self._getSearchIndexMatcher(ignoreSearchIndex, report), report)
+
+    def _canFind(self, query, maxDepth, filter, targetQuery, targetFilter,
+                 queryFactory, getQueries, getMatches, report=None):
+        # canFind, for a normalized query; see _findValueTokens
+        if (((maxDepth is None and queryFactory is None)
+                or maxDepth == 1)
+                and filter is None
+                and not targetQuery
+                and targetFilter is None):
+            _report(report, 'path', 'direct')
+            return bool(self._relData(query, _steps(report, 'relData')))
+        if getMatches is not None and self._searchIndexMatches is not None:
+            self.updateSearchIndexes()
+            matches = getMatches(None, query, maxDepth, filter, queryFactory)
+            if targetQuery and targetFilter is None:
+                res = self._getSearchIndexReach(
+                    matches, query, maxDepth, filter, targetQuery,
+                    queryFactory, report)
+                if res is not None:
+                    return res
             res = self._getSearchIndexResults(
-                key, query, maxDepth, filter, targetQuery, targetFilter,
-                queryFactory)
+                matches, None, query, maxDepth, filter, queryFactory, report)
             if res is not None:
+                if res:
+                    res = self._getTargetResults(
+                        res, query, targetQuery, targetFilter, report)
                 return bool(res)
         if getQueries is None:
             queryFactory, getQueries = self._getQueryFactory(
                 query, queryFactory)
-
-        _ = next(self.yieldRelationTokenChains(
+            _report(report, 'queryFactory', queryFactory)
+        if targetQuery:
+            transposition = self._getTransposition(
+                query, filter, targetFilter, queryFactory, getQueries)
+            if transposition is not None:
+                _checkMaxDepth(maxDepth)
+                _report(report, 'path', 'transposed')
+                return self._canFindTransposed(
+                    query, transposition, maxDepth, targetQuery, report)
+        _report(report, 'path', 'traversal')
+        _ = next(self._yieldFoundChains(
             *self._parse(
                 query, maxDepth, filter, targetQuery,
-                targetFilter, getQueries) +
-            (False,)), _marker)
+                targetFilter, getQueries, report), report=report), _marker)
         if _ is _marker:
             return False
         else:
             return True
+
+    def explain(self, method, *args, **kwargs):
+        search = {'findRelationTokens': self._searchRelationTokens,
+                  'findValueTokens': self._searchValueTokens,
+                  'canFind': self._searchCanFind}.get(method)
+        if search is None:
+            raise ValueError('cannot explain', method)
+        arguments = inspect.signature(getattr(self, method)).bind(
+            *args, **kwargs)
+        arguments.apply_defaults()
+        # the search records what it does in the report as it goes
+        res = {'method': method, 'path': None, 'queryFactory': None,
+               'relData': [], 'targetRelData': [], 'searchIndexes': [],
+               'levels': [], 'expanded': 0, 'chains': 0}
+        result = search(*arguments.args, report=res)
+        if method == 'canFind':
+            res['result'] = result
+        elif isinstance(result, dict):  # byDepth
+            res['result'] = sum(len(tokens) for tokens in result.values())
+        else:
+            res['result'] = sum(1 for token in result)
+        return res
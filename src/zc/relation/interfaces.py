@@ -30,7 +30,8 @@ class IQueryFactory(zope.interface.Interface):
 
         A getQueries callable receives a relchain.  The last relation token in
         relchain is the most recent, and if you are using search indexes may be
-        the only reliable one.  Return an iterable of queries to search
+        the only reliable one.  The relchain is a sequence of relation tokens,
+        but not necessarily a tuple.  Return an iterable of queries to search
         further from given relchain.
 
         IMPORTANT: the getQueries is first called with an empty tuple.  This
@@ -39,16 +40,64 @@ class IQueryFactory(zope.interface.Interface):
         """
 
 
+class ITransposingQueryFactory(IQueryFactory):
+    """A query factory that walks from relations to relations by transposing
+    two names.
+
+    Relations found this way can be searched a level at a time with BTree set
+    operations, rather than a chain at a time.  The catalog only does this
+    when the class that defines `__call__` also defines `getTransposition`,
+    so subclasses that only change `__call__` are still called.
+    """
+
+    def getTransposition(query):
+        """return (name, other, static) if the factory matches query; or None.
+
+        From a relation, the factory walks to the relations whose `name`
+        values include the `other` values of the relation.  Either name may
+        be RELATION (None), meaning the relation tokens themselves.  `static`
+        is a tuple of (name, value) pairs of the query that every further
+        relation must also match.
+        """
+
+
 class IFilter(zope.interface.Interface):
     def __call__(relchain, query, index, cache):
         """return boolean: whether to accept the given relchain.
-        last relation token in relchain is the most recent.
+        last relation token in relchain is the most recent.  relchain is a
+        sequence of relation tokens, but not necessarily a tuple.
         query is original query that started the search.
         Used for the filter and targetFilter arguments of the IIndex query
         methods.  Cache is a dictionary that will be used throughout a given
         search."""
 
 
+class IPathIndependentFilter(IFilter):
+    """A filter whose answer depends only on the last relation in relchain.
+
+    Declaring a filter with this interface (for a function, use
+    zope.interface.directlyProvides) lets searches that only return relations
+    or values visit each relation once, by the first and shortest chain that
+    reaches it, rather than walking every distinct path.  The relchain the
+    filter receives is then one of possibly many chains to its last relation.
+    """
+
+
+class IPathIndependentQueries(zope.interface.Interface):
+    """A getQueries callable, as a query factory returns, whose queries
+    depend only on the last relation in relchain.
+
+    A query factory that declares the getQueries it returns with this
+    interface (with zope.interface.directlyProvides) lets searches that only
+    return relations or values visit each relation once, as for
+    IPathIndependentFilter.  The getQueries of
+    zc.relation.queryfactory.TransposingTransitive provides it.
+    """
+
+    def __call__(relchain):
+        """return an iterable of queries to search further from relchain"""
+
+
 class IMessageListener(zope.interface.Interface):
 
     def relationAdded(token, catalog, additions):
@@ -78,6 +127,38 @@ class IMessageListener(zope.interface.Interface):
         """message: the catalog has been cleared."""
 
 
+class IBatchMessageListener(IMessageListener):
+    """A listener that can receive the changes to many relations at once.
+
+    The catalog's ``index_docs`` and ``unindex_docs`` (and ``indexMany`` and
+    ``unindexMany``) send these messages once all of the relations in a batch
+    have been indexed, so the catalog reflects the whole batch.  Other
+    listeners are sent the per-relation messages instead, through
+    ``zc.relation.catalog.BatchMessageAdapter``.
+    """
+
+    def relationsAdded(changes, catalog):
+        """message: relations have been added to catalog.
+
+        changes is a sequence of (token, additions) pairs, as for
+        ``relationAdded``.
+        """
+
+    def relationsModified(changes, catalog):
+        """message: relations have been updated in catalog.
+
+        changes is a sequence of (token, additions, removals) triples, as for
+        ``relationModified``.
+        """
+
+    def relationsRemoved(changes, catalog):
+        """message: relations have been removed from catalog.
+
+        changes is a sequence of (token, removals) pairs, as for
+        ``relationRemoved``.
+        """
+
+
 class IListener(IMessageListener):
 
     def sourceAdded(catalog):
@@ -123,16 +204,74 @@ class ISearchIndex(IMessageListener):
         """
 
 
+class IReachabilitySearchIndex(ISearchIndex):
+    """a search index that can answer ``canFind`` with a ``targetQuery``
+    without computing every result of the search."""
+
+    def canFind(query, targetQuery, maxDepth, filter, queryFactory):
+        """return whether a relation matching the targetQuery can be found
+        from the query, or None if not available.
+
+        Only called for searches without a targetFilter that match one of the
+        tuples returned by ``setCatalog``.  Returning a non-None value means
+        that this search index claims the search, as with ``getResults``.
+        """
+
+
+class IRecyclePolicy(zope.interface.Interface):
+    """chooses how to change the token set of a relation for a value index
+    when the relation is indexed again and some tokens are removed."""
+
+    def recycle(tokens, removed):
+        """return whether to remove the `removed` tokens from the `tokens`
+        set, and add the new ones, rather than building a new set.
+
+        `removed` is a set of tokens in `tokens`, and not empty."""
+
+
+class IPreparedQuery(zope.interface.Interface):
+    """a search of a catalog, prepared to be run with different tokens."""
+
+    catalog = zope.interface.Attribute("the catalog that is searched")
+
+    name = zope.interface.Attribute(
+        """the name of the value index whose tokens are found, or None to
+        find relation tokens""")
+
+    queryNames = zope.interface.Attribute(
+        "the names of the query, a tuple")
+
+    targetNames = zope.interface.Attribute(
+        "the names of the targetQuery, a tuple")
+
+    def find(*values):
+        """find the tokens for the query and targetQuery of the given tokens.
+
+        The values are the tokens for queryNames followed by the tokens for
+        targetNames.  The result is that of findValueTokens(name, ...) if
+        name is not None, and of findRelationTokens otherwise."""
+
+    def canFind(*values):
+        """boolean if there is any result for the search of the given
+        tokens, as for ICatalog.canFind."""
+
+
 class ICatalog(zope.interface.Interface):
 
     family = zope.interface.Attribute(
         """BTrees.family32 or BTrees.family64.  Influences defaults.""")
 
-    def index(relation):
+    def index(relation, names=None):
         """obtains the token for the relation and indexes"""
 
-    def index_doc(token, relation):
-        """indexes relation as given token"""
+    def index_doc(token, relation, names=None):
+        """indexes relation as given token.
+
+        If the relation is already indexed and ``names`` is given (a value
+        index name or a sequence of them), only those value indexes are
+        reindexed, and listeners only hear about changes to them.  A
+        relation that is not yet indexed is always indexed for every value
+        index.  A name that is not indexed raises a ValueError."""
 
     def unindex(relation):
         """obtains the token for the relation and unindexes"""
@@ -140,6 +279,24 @@ class ICatalog(zope.interface.Interface):
     def unindex_doc(relation):
         """unindexes relation for given token"""
 
+    def indexMany(relations, names=None):
+        """obtains the tokens for the relations and indexes them together"""
+
+    def index_docs(pairs, names=None):
+        """indexes an iterable of (token, relation) pairs together.
+
+        Each posting set is written once for the batch, and listeners are
+        notified once all of the relations are indexed.  If a token appears
+        more than once, the last relation given for it is indexed.
+        ``names`` limits the reindexing of relations that are already
+        indexed, as with ``index_doc``."""
+
+    def unindexMany(relations):
+        """obtains the tokens for the relations and unindexes them together"""
+
+    def unindex_docs(tokens):
+        """unindexes the relations for an iterable of tokens together"""
+
     def __contains__(relation):
         """returns whether the relation is in the index"""
 
@@ -156,7 +313,7 @@ class ICatalog(zope.interface.Interface):
         """return a copy of index, using klass (__new__) if given."""
 
     def addValueIndex(element, dump=None, load=None, btree=None,
-                      multiple=False, name=None):
+                      multiple=False, name=None, recyclePolicy=None):
         """add a value index for given element.
 
         element may be interface element or callable.  Here are the other
@@ -172,13 +329,18 @@ class ICatalog(zope.interface.Interface):
           for `dump` or `load`, you must also specify None for the other.
 
         - `btree` is the btree module to use to store and process the tokens,
-          such as BTrees.OOBTree.  Defaults to catalog.family.IFBTree.
+          such as BTrees.OOBTree, or zc.relation.bitmap for compressed sets
+          of non-negative integer tokens.  Defaults to
+          catalog.family.IFBTree.
 
         - `multiple` is a boolean indicating whether the value is a
           collection.
 
         - `name` is the name of the index in the catalog.  If this is not
           supplied, the element's `__name__` is used.
+
+        - `recyclePolicy` is an IRecyclePolicy to use for this value index,
+          instead of the catalog's `recyclePolicy`.
         """
 
     def iterValueIndexInfo():
@@ -189,6 +351,49 @@ class ICatalog(zope.interface.Interface):
     def removeValueIndex(name):
         """remove value index of given name"""
 
+    inlineLimit = zope.interface.Attribute(
+        """the most relations that a value token keeps in a tuple, inline
+        in the BTree of its value index, rather than in a set and a length
+        of their own.  Value tokens with more relations are moved to a set
+        as they are indexed.  0 by default: the sets are always used.""")
+
+    recyclePolicy = zope.interface.Attribute(
+        """the IRecyclePolicy that value indexes without their own use.
+        Defaults to a zc.relation.catalog.RecyclePolicy with its default
+        thresholds.""")
+
+    def addFingerprints():
+        """keep a fingerprint of the indexed values of each relation.
+
+        The fingerprint is a hash of the tokens of all of the relation's
+        value indexes.  When a relation is indexed again, and the tokens of
+        its values have the same fingerprint, the catalog does nothing more:
+        it does not compare the tokens, and sends no messages.  This makes
+        reindexing relations that did not change cheaper, and other
+        reindexing a little more costly.  Reindexing only some value indexes,
+        with ``names``, always compares their tokens.
+
+        Fingerprints are blake2b digests of the tokens, the same in every
+        process.  Tokens other than integers, strings, bytes and tuples of
+        them are digested by their repr, which should not change between
+        processes.  Raises ValueError if fingerprints are already kept."""
+
+    def removeFingerprints():
+        """stop keeping fingerprints.
+
+        Raises LookupError if fingerprints are not kept."""
+
+    def getFingerprint(token):
+        """return the fingerprint of the relation with the given token, or
+        None if there is none."""
+
+    def migrate(size=None):
+        """move the value tokens of a catalog from an older version to the
+        current storage, for `size` relations (or all of them, if None).
+
+        Returns True if there are more to move, and False otherwise.  The
+        catalog can be used, and changed, between calls."""
+
     def addListener(listener):
         """add a listener.
 
@@ -220,6 +425,16 @@ class ICatalog(zope.interface.Interface):
     def removeSearchIndex(ix):
         """remove search index"""
 
+    deferred = zope.interface.Attribute(
+        """If True, changes are sent to the search indexes once per
+        transaction, when it commits, or before a search uses them; rather
+        than as each relation is indexed.  The changes to a relation are
+        merged.  Other listeners are still told at once.  Requires the
+        transaction package.  False by default.""")
+
+    def updateSearchIndexes():
+        """send the changes deferred for the search indexes now."""
+
     def getRelationModuleTools():
         """return dict with useful BTree tools.
 
@@ -262,33 +477,55 @@ class ICatalog(zope.interface.Interface):
 
         TODO: explain. :-/"""
 
+    def yieldShortestRelationTokenChains(query, relData, maxDepth,
+                                         checkFilter, checkTargetFilter,
+                                         getQueries):
+        """like yieldRelationTokenChains, but visits each relation only once.
+
+        Yields, breadth first, the first (and therefore shortest) chain found
+        to each relation.  Cycles are not reported.  Only gives the same
+        relations as yieldRelationTokenChains if checkFilter and
+        checkTargetFilter are None or provide IPathIndependentFilter, and
+        getQueries is None or provides IPathIndependentQueries."""
+
     def findValueTokens(
             name, query=None, maxDepth=None, filter=None, targetQuery=None,
-            targetFilter=None, queryFactory=None, ignoreSearchIndex=False):
+            targetFilter=None, queryFactory=None, ignoreSearchIndex=False,
+            minDepth=None, byDepth=False):
         """find token results for searchTerms.
         - name is the index name wanted for results.
         - if query is None (or evaluates to boolean False), returns the
           underlying btree data structure; which is an iterable result but
           can also be used with BTree operations
+        - minDepth is None or a positive integer that excludes the values
+          first found at a shallower depth.
+        - if byDepth is True, returns a dict of depth to the set of value
+          tokens first found at that depth.
         Otherwise, same arguments as findRelationChains.
         """
 
     def findValues(
             name, query=None, maxDepth=None, filter=None, targetQuery=None,
-            targetFilter=None, queryFactory=None, ignoreSearchIndex=False):
+            targetFilter=None, queryFactory=None, ignoreSearchIndex=False,
+            minDepth=None):
         """Like findValueTokens, but resolves value tokens"""
 
     def findRelations(
             query=(), maxDepth=None, filter=None, targetQuery=None,
-            targetFilter=None, queryFactory=None, ignoreSearchIndex=False):
+            targetFilter=None, queryFactory=None, ignoreSearchIndex=False,
+            minDepth=None):
         """Given a single dictionary of {indexName: token}, return an iterable
         of relations that match the query"""
 
     def findRelationTokens(
             query=(), maxDepth=None, filter=None, targetQuery=None,
-            targetFilter=None, queryFactory=None, ignoreSearchIndex=False):
+            targetFilter=None, queryFactory=None, ignoreSearchIndex=False,
+            minDepth=None, byDepth=False):
         """Given a single dictionary of {indexName: token}, return an iterable
-        of relation tokens that match the query"""
+        of relation tokens that match the query.
+
+        minDepth and byDepth are as for findValueTokens.  A relation's depth
+        is the length of the shortest chain to it."""
 
     def findRelationTokenChains(
             query, maxDepth=None, filter=None, targetQuery=None,
@@ -318,6 +555,35 @@ class ICatalog(zope.interface.Interface):
             targetFilter=None, queryFactory=None):
         "Like findRelationTokenChains, but resolves relation tokens"
 
+    def findShortestRelationTokenChain(
+            query, targetQuery, maxDepth=None, filter=None,
+            queryFactory=None):
+        """find one of the shortest tuples of relation tokens from the query
+        to the targetQuery, or None if there is no such chain.
+
+        The arguments are the same as for findRelationTokenChains.  The
+        search is breadth first, and, if filter is None or provides
+        IPathIndependentFilter, and the getQueries of the query factory
+        provides IPathIndependentQueries, each relation is only expanded
+        once."""
+
+    def findShortestRelationChain(
+            query, targetQuery, maxDepth=None, filter=None,
+            queryFactory=None):
+        "Like findShortestRelationTokenChain, but resolves relation tokens"
+
+    def prepare(name=None, queryNames=(), maxDepth=None, filter=None,
+                targetNames=(), targetFilter=None, queryFactory=None,
+                ignoreSearchIndex=False):
+        """return an IPreparedQuery for searches of the given names.
+
+        - name is the value index name of the results, or None for relation
+          tokens.
+        - queryNames and targetNames are the names (value index names or
+          RELATION) of the query and targetQuery of the searches.
+        Otherwise, same arguments as findValueTokens.  Names that are not
+        indexed, and invalid maxDepths, raise a ValueError."""
+
     def canFind(query, maxDepth=None, filter=None, targetQuery=None,
                 targetFilter=None, queryFactory=None, ignoreSearchIndex=False):
         """boolean if there is any result for the given search.
@@ -328,6 +594,27 @@ class ICatalog(zope.interface.Interface):
         try to yield a single chain from findRelationTokenChains with the
         given arguments.  If one can be found, return True, else False."""
 
+    def explain(method, *args, **kwargs):
+        """run a search and return a dict that describes how it was done.
+
+        method is 'findRelationTokens', 'findValueTokens' or 'canFind',
+        and the other arguments are those of the method.  The dict has:
+        - method;
+        - path: 'direct', 'search index', 'transposed' or 'traversal';
+        - queryFactory: the query factory used, or None;
+        - searchIndexes: a (key, search index, reason) tuple for each search
+          index that might answer the search, where the reason is 'used',
+          'declined', 'filter', 'queryFactory', 'static' or
+          'not reachability'; or (key, None, 'no search index');
+        - relData and targetRelData: a (name, length, action, count) tuple
+          for each name of the query and targetQuery, in the order used;
+        - levels: the number of relations found at each depth of a
+          transposed search;
+        - expanded and chains: the number of chains given to the query
+          factory, and found, by a traversal;
+        - result: the number of tokens found, or the result of canFind.
+        Any other method is a ValueError."""
+
     def tokenizeQuery(query):
         '''Given a dictionary of {indexName: value} returns a dictionary of
         {indexname: token} appropriate for the search methods'''
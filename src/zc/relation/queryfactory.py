@@ -25,7 +25,8 @@ import zc.relation.interfaces
 _marker = object()
 
 
-@zope.interface.implementer(zc.relation.interfaces.IQueryFactory)
+@zope.interface.implementer(
+    zc.relation.interfaces.ITransposingQueryFactory)
 class TransposingTransitive(persistent.Persistent):
 
     def __init__(self, name1, name2, static=()):
@@ -34,7 +35,7 @@ class TransposingTransitive(persistent.Persistent):
             static = static.items()
         self.static = tuple(sorted(static))
 
-    def __call__(self, query, catalog):
+    def getTransposition(self, query):
         # check static values, if any.  we want to be permissive here. (as
         # opposed to finding searchindexes in the catalog's
         # _getSearchIndexResults method)
@@ -64,6 +65,13 @@ class TransposingTransitive(persistent.Persistent):
                     name = nm
                     other = self.names[not ix]
         if name is not _marker:
+            return name, other, tuple(static)
+
+    def __call__(self, query, catalog):
+        transposition = self.getTransposition(query)
+        if transposition is not None:
+            name, other, static = transposition
+
             def getQueries(relchain):
                 if not relchain:
                     yield query
@@ -78,6 +86,8 @@ class TransposingTransitive(persistent.Persistent):
                 res = BTrees.family32.OO.Bucket(static)
                 res[name] = rels
                 yield res
+            zope.interface.directlyProvides(
+                getQueries, zc.relation.interfaces.IPathIndependentQueries)
             return getQueries
 
     def __eq__(self, other):
@@ -11,10 +11,16 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
 import copy
+import itertools
+import random
+import time
 
 import BTrees
+import BTrees.Length
 import persistent
+import persistent.list
 import zope.interface
 
 import zc.relation.catalog
@@ -29,7 +35,50 @@ import zc.relation.searchindex
 _marker = object()
 
 
-@zope.interface.implementer(zc.relation.interfaces.ISearchIndex)
+def _components(tokens, getChildren):
+    # Tarjan's algorithm, without recursion.  Yields the strongly connected
+    # components of the graph of ``tokens``, each as a list, and each after
+    # all of the components it can reach.
+    index = {}
+    low = {}
+    stack = []
+    onStack = set()
+    for root in tokens:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        onStack.add(root)
+        work = [(root, iter(getChildren(root)))]
+        while work:
+            token, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(getChildren(child))))
+                    break
+                elif child in onStack:
+                    low[token] = min(low[token], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[token])
+                if low[token] == index[token]:
+                    component = []
+                    while 1:
+                        member = stack.pop()
+                        onStack.discard(member)
+                        component.append(member)
+                        if member == token:
+                            break
+                    yield component
+
+
+@zope.interface.implementer(zc.relation.interfaces.ISearchIndex,
+                            zc.relation.interfaces.IBatchMessageListener)
 class TransposingTransitiveMembership(persistent.Persistent):
     """for searches using zc.relation.queryfactory.TransposingTransitive.
 
@@ -62,9 +111,23 @@ class TransposingTransitiveMembership(persistent.Persistent):
     The basic index is for relations.  By providing ``names`` to the
     initialization, the named value indexes will also be included in the
     transitive search index.
+
+    Changes are maintained incrementally.  When a relation only gains values,
+    the new results are added in place to the results above it, stopping
+    where nothing is missing.  Otherwise, the relations above it are visited
+    bottom up by strongly connected component, and a token is only removed
+    if no member or child of the component still has it.  Only the
+    components with a changed relation are computed from scratch.
+
+    The strongly connected components (the cycles) are kept in
+    ``components``, mapping each member to a representative member, and in
+    ``members``, mapping the representative to all of the members.  Only
+    components with more than one member are kept.  The members of a
+    component share one set of results, so an edit to a cycle is written
+    once, and changes are propagated through the graph of the components.
     """
 
-    name = index = catalog = None
+    name = index = catalog = components = members = None
 
     def __init__(self, forward, reverse, names=(), static=()):
         # normalize
@@ -84,11 +147,8 @@ class TransposingTransitiveMembership(persistent.Persistent):
         new.names = BTrees.family32.OO.Bucket()
         for nm, val in self.names.items():
             if val is not None:
-                new_val = zc.relation.catalog.getMapping(
-                    self.catalog.getValueModuleTools(nm))()
-                for k, v in val.items():
-                    new_val[k] = copy.copy(v)
-                val = new_val
+                val = self._copyShared(
+                    val, self.catalog.getValueModuleTools(nm))
             new.names[nm] = val
         new.forward = self.forward
         new.reverse = self.reverse
@@ -96,28 +156,35 @@ class TransposingTransitiveMembership(persistent.Persistent):
         new.factory = self.factory
         if self.index is not None:
             new.catalog = catalog
-            new.index = zc.relation.catalog.getMapping(
-                self.catalog.getRelationModuleTools())()
-            for k, v in self.index.items():
-                new.index[k] = copy.copy(v)
-        new.factory = self.factory
+            new.index = self._copyShared(
+                self.index, self.catalog.getRelationModuleTools())
+            if self.components is not None:
+                tools = self.catalog.getRelationModuleTools()
+                new.components = zc.relation.catalog.getMapping(tools)()
+                new.components.update(self.components)
+                new.members = self._copyShared(self.members, tools)
         return new
 
+    def _copyShared(self, ix, tools):
+        # copy the sets of a mapping, keeping them shared within cycles
+        res = zc.relation.catalog.getMapping(tools)()
+        copies = {}
+        for k, v in ix.items():
+            c = copies.get(id(v))
+            if c is None:
+                c = copies[id(v)] = copy.copy(v)
+            res[k] = c
+        return res
+
     def setCatalog(self, catalog):
         if catalog is None:
             self.index = self.catalog = None
+            self.components = self.members = None
             return
         elif self.catalog is not None:
             raise ValueError('catalog already set')
         self.catalog = catalog
-        self.index = zc.relation.catalog.getMapping(
-            self.catalog.getRelationModuleTools())()
-        for nm in self.names.keys():
-            self.names[nm] = zc.relation.catalog.getMapping(
-                self.catalog.getValueModuleTools(nm))()
-        for token in catalog.getRelationTokens():
-            if token not in self.index:
-                self._index(token)
+        self._build()
         # name, query_names, static_values, maxDepth, filter, queryFactory
         res = [(None, (self.forward,), self.factory.static, None, None,
                 self.factory)]
@@ -127,120 +194,418 @@ class TransposingTransitiveMembership(persistent.Persistent):
                  self.factory))
         return res
 
-    def _index(self, token, removals=None, remove=False):
+    def _build(self):
+        Mapping = zc.relation.catalog.getMapping(
+            self.catalog.getRelationModuleTools())
+        self.index = Mapping()
+        self.components = Mapping()
+        self.members = Mapping()
+        for nm in self.names.keys():
+            self.names[nm] = zc.relation.catalog.getMapping(
+                self.catalog.getValueModuleTools(nm))()
+        tokens = set(self.catalog.getRelationTokens())
+        self._rebuild(tokens, tokens)
+
+    def _getQueries(self, name):
+        # the query factory's getQueries walking down (from ``forward``) or
+        # up (from ``reverse``).
+        query = BTrees.family32.OO.Bucket(
+            ((name, None),) + self.factory.static)
+        return query, self.factory(query, self.catalog)
+
+    def _getChildren(self, token, getQueries, relTools):
+        return zc.relation.catalog.multiunion(
+            (self.catalog.getRelationTokens(q) for q in getQueries([token])),
+            relTools)
+
+    def _getStarts(self, token, additions, removals):
+        # the token, and the relations that gained or lost it as a child,
+        # which are found with the ``forward`` values it gained or lost.
         starts = {token}
-        if removals and self.forward in removals:
-            starts.update(t for t in removals[self.forward] if t is not None)
-        tokens = set()
-        reverseQuery = BTrees.family32.OO.Bucket(
-            ((self.reverse, None),) + self.factory.static)
-        for token in starts:
-            getQueries = self.factory(dict(reverseQuery), self.catalog)
-            tokens.update(chain[-1] for chain in
-                          self.catalog.yieldRelationTokenChains(
-                              reverseQuery, ((token,),), None, None, None,
-                              getQueries))
-        if remove:
-            tokens.remove(token)
+        for changes in (additions, removals):
+            if not changes or not changes.get(self.forward):
+                continue
+            for value in changes[self.forward]:
+                if value is not None:
+                    rels = self.catalog.getRelationTokens(
+                        BTrees.family32.OO.Bucket(
+                            ((self.reverse, value),) + self.factory.static))
+                    if rels:
+                        starts.update(rels)
+        return starts
+
+    def _getGained(self, token, additions):
+        # the relations that the relation gained as children.
+        res = set()
+        for value in additions.get(self.reverse) or ():
+            if value is not None:
+                rels = self.catalog.getRelationTokens(
+                    BTrees.family32.OO.Bucket(
+                        ((self.forward, value),) + self.factory.static))
+                if rels:
+                    res.update(rels)
+        return res
+
+    def _getAncestors(self, starts, maxDepth=None):
+        # the starts, and the relations that can reach them.
+        query, getQueries = self._getQueries(self.reverse)
+        return {chain[-1] for chain in
+                self.catalog.yieldShortestRelationTokenChains(
+                    query, (starts,), maxDepth, None, None, getQueries)}
+
+    def _index(self, token, additions=None, removals=None, remove=False):
+        if self.components is None:
+            self._build()  # an index from before components were kept
+            return
+        if remove or removals and self._getWatched().intersection(removals):
+            self._rebuildAbove(self._getStarts(token, additions, removals),
+                               (token,) if remove else ())
+        else:
+            self._add(token, additions)
+
+    def _indexMany(self, changes):
+        # the changes of a batch are applied together: one rebuild above
+        # all of them.
+        if self.components is None:
+            self._build()
+            return
+        starts, removed = self._getBatchStarts(changes, self.index)
+        if starts:
+            self._rebuildAbove(starts, removed)
+
+    def _getBatchStarts(self, changes, indexed):
+        # the starts of the changes in a batch that may change results, and
+        # the removed relations.
+        watched = self._getWatched()
+        starts = set()
+        removed = set()
+        for token, additions, removals, remove in changes:
+            if remove:
+                removed.add(token)
+            elif (token in indexed and
+                    not watched.intersection(additions or ()) and
+                    not watched.intersection(removals or ())):
+                continue  # no changes
+            starts.update(self._getStarts(token, additions, removals))
+        return starts, removed
+
+    def _rebuildAbove(self, starts, removed):
+        tokens = self._getAncestors(starts)
+        tokens.difference_update(removed)
+        starts.difference_update(removed)
+        for token in removed:
             self.index.pop(token, None)
             for ix in self.names.values():
                 ix.pop(token, None)
-        # because of the possibility of cycles involving this token in the
-        # previous state, we first clean out all of the items "above"
-        for token in tokens:
-            self.index.pop(token, None)
-        # now we go back and try to fill them back in again.  If there had
-        # been a cycle, we can see now that we have to work down.
+            self._forget(token)
+        self._rebuild(tokens, starts)
+
+    def _add(self, token, additions):
+        # The relation is new, or has only gained values.  Results only grow,
+        # so we add what is missing to the relation's results, and then to
+        # the results of the relations above it, stopping wherever nothing
+        # is missing: everything above those already has it.
         relTools = self.catalog.getRelationModuleTools()
-        query = BTrees.family32.OO.Bucket(
-            ((self.forward, None),) + self.factory.static)
-        getQueries = self.factory(query, self.catalog)
+        query, getQueries = self._getQueries(self.forward)
+        children = self._getChildren(token, getQueries, relTools)
+        others = [child for child in children if child != token]
+        rels = self.index.get(token)
+        # if the relation is new, or may have new parents, its parents need
+        # all of its results.  Otherwise they only need what it gained.
+        full = rels is None or not additions or self.forward in additions
+        # a new relationship may close a cycle
+        linked = full or self.reverse in additions
+        if rels is None:
+            rels = self.index[token] = relTools['TreeSet']()
+        found = zc.relation.catalog.multiunion(
+            [relTools['Set']((token,)), children] +
+            [self.index.get(child) for child in others], relTools)
+        missing = [rel for rel in found if rel not in rels]
+        rels.update(missing)
+        delta = rels if full else missing
+        updated = {id(rels)}
+        names = {}
+        for nm, ix in self.names.items():
+            tools = self.catalog.getValueModuleTools(nm)
+            values = ix.get(token)
+            if values is None:
+                values = ix[token] = tools['TreeSet']()
+            found = zc.relation.catalog.multiunion(
+                [self.catalog.getValueTokens(nm, token)] +
+                [ix.get(child) for child in others], tools)
+            missing = [value for value in found if value not in values]
+            values.update(missing)
+            names[nm] = values if full else missing
+            updated.add(id(values))
+        if delta or any(names.values()):
+            self._propagate(token, delta, names, updated)
+        if linked and any(token in self.index[child] for child in others):
+            # the relation is in a cycle, so its component may have grown.
+            # The members' results are now the same: share one set.
+            component = [rel for rel in self.index[token]
+                         if rel == token or token in self.index[rel]]
+            for ix in (self.index,) + tuple(self.names.values()):
+                res = ix[token]
+                for rel in component:
+                    if ix[rel] is not res:
+                        ix[rel] = res
+            self._record(component)
+
+    def _propagate(self, token, delta, names, updated):
+        # add the ``delta`` and the ``names`` deltas to the results above
+        # the token, a component at a time.
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.reverse)
+        seen = {token}
+        queue = collections.deque((token,))
+        while queue:
+            for rel in self._getChildren(queue.popleft(), getQueries,
+                                         relTools):
+                if rel in seen:
+                    continue
+                rels = self.index.get(rel)
+                if rels is None:
+                    seen.add(rel)
+                    continue
+                rep = self.components.get(rel)
+                group = (rel,) if rep is None else tuple(self.members[rep])
+                seen.update(group)
+                walk = False
+                for ix, values in [(self.index, delta)] + [
+                        (ix, names[nm]) for nm, ix in self.names.items()]:
+                    for member in group:
+                        res = ix[member]
+                        if id(res) in updated:
+                            # a set shared within a cycle
+                            walk = True
+                            continue
+                        missing = [t for t in values if t not in res]
+                        if missing:
+                            res.update(missing)
+                            updated.add(id(res))
+                            walk = True
+                if walk:
+                    queue.extend(group)
+
+    def _rebuild(self, tokens, dirty):
+        # Update the results of the ``tokens``, which must include all of
+        # the relations above the ``dirty`` ones.  The strongly connected
+        # components are visited bottom up.  A component with a dirty member
+        # has its results recomputed as its members and their children's
+        # results.  The others only consider what their children gained and
+        # lost: a lost token is only removed if no member or child still
+        # supports it.  Components whose children did not change are skipped.
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.forward)
+        children = {token: self._getChildren(token, getQueries, relTools)
+                    for token in tokens}
+        indexes = [(None, self.index, relTools)]
+        for nm, ix in self.names.items():
+            indexes.append((nm, ix, self.catalog.getValueModuleTools(nm)))
+        # the recorded components that may not have changed are visited as
+        # one node, named by their representative.
+        broken = {self.components.get(token) for token in dirty}
+        # a batch may be sent in parts, so a component may have members
+        # that changed in a later part, and that no longer reach the
+        # others: it is broken too.
+        for token in tokens:
+            rep = self.components.get(token)
+            if rep is not None and rep not in broken and any(
+                    member not in tokens for member in self.members[rep]):
+                broken.add(rep)
+        nodes = {}
+        for token in tokens:
+            rep = self.components.get(token)
+            nodes[token] = token if rep is None or rep in broken else rep
+        links = {}
         for token in tokens:
-            if token in self.index:  # must have filled it in during a cycle
+            node = nodes[token]
+            links.setdefault(node, set()).update(
+                nodes[c] for c in children[token] if c in tokens)
+        components = []
+        for component in _components(
+                links, lambda node: [c for c in links[node] if c != node]):
+            expanded = []
+            for node in component:
+                if node not in broken and self.components.get(node) == node:
+                    expanded.extend(self.members[node])
+                else:
+                    expanded.append(node)
+            components.append(expanded)
+        # the sets are shared within cycles.  If a cycle was broken, a set
+        # may be shared by more than one component, which each need their
+        # own.  That includes members of the cycle that are not rebuilt now,
+        # whose results must not change in place.
+        outsiders = [token for rep in broken if rep is not None
+                     for token in self.members.get(rep, ())
+                     if token not in tokens]
+        shared = []
+        for nm, ix, tools in indexes:
+            holders = {}
+            for component in components:
+                for token in component:
+                    holders.setdefault(id(ix.get(token)), set()).add(
+                        id(component))
+            for token in outsiders:
+                holders.setdefault(id(ix.get(token)), set()).add(None)
+            shared.append({k for k, v in holders.items() if len(v) > 1})
+        deltas = {}  # token: [(gained, lost) for each of indexes]
+        for component in components:
+            self._record(component)
+            members = set(component)
+            outside = set()
+            for token in component:
+                outside.update(children[token])
+            outside.difference_update(members)
+            changes = [deltas[c] for c in outside if c in deltas]
+            recompute = not members.isdisjoint(dirty)
+            split = [not s.isdisjoint(id(ix.get(token)) for token in component)
+                     for s, (nm, ix, tools) in zip(shared, indexes)]
+            if not recompute and not changes and not any(split):
                 continue
-            stack = [[token, None, set(), [], {token}, False]]
-            while stack:
-                token, child, sets, empty, traversed_tokens, cycled = stack[-1]
-                if not sets:
-                    rels = zc.relation.catalog.multiunion(
-                        (self.catalog.getRelationTokens(q) for q in
-                         getQueries([token])), relTools)
-                    for rel in rels:
-                        if rel == token:
-                            # cycles on itself.
-                            sets.add(relTools['Set']((token,)))
-                            continue
-                        indexed = self.index.get(rel)
-                        if indexed is None:
-                            iterator = reversed(stack)
-                            traversed = [next(iterator)]
-                            for info in iterator:
-                                if rel == info[0]:
-                                    sets = info[2]
-                                    traversed_tokens = info[4]
-                                    cycled = True
-                                    for trav in traversed:
-                                        sets.update(trav[2])
-                                        trav[2] = sets
-                                        traversed_tokens.update(trav[4])
-                                        trav[4] = traversed_tokens
-                                        trav[5] = True
-                                    break
-                                traversed.append(info)
-                            else:
-                                empty.append(rel)
-                        else:
-                            sets.add(indexed)
-                    sets.add(rels)
-                if child is not None:
-                    sets.add(child)
-                    # clear it out
-                    child = stack[-1][1] = None
-                if empty:
-                    # We have one of two classes of situations.  Either this
-                    # *is* currently a cycle, and the result for this and all
-                    # children will be the same set; or this *may* be
-                    # a cycle, because this is an initial indexing.
-                    # Walk down, passing token.
-                    _next = empty.pop()
-                    stack.append(
-                        [_next, None, set(), [], {_next}, False])
+            res = []
+            for i, (nm, ix, tools) in enumerate(indexes):
+                olds = {}
+                for token in component:
+                    old = ix.get(token)
+                    olds[id(old)] = old
+                # a newly formed or merged cycle has more than one set.
+                if (recompute or split[i] or len(olds) > 1 or
+                        None in olds.values()):
+                    gained, lost = self._recompute(
+                        nm, ix, tools, component, outside, olds, split[i])
                 else:
-                    stack.pop()
-                    assert stack or not cycled, (
-                        'top level should never consider itself cycled')
-                    if not cycled:
-                        rels = zc.relation.catalog.multiunion(
-                            sets, relTools)
-                        rels.insert(token)
-                        names = {}
-                        for nm in self.names.keys():
-                            names[nm] = zc.relation.catalog.multiunion(
-                                (self.catalog.getValueTokens(nm, rel)
-                                 for rel in rels),
-                                self.catalog.getValueModuleTools(nm))
-                        for token in traversed_tokens:
-                            self.index[token] = rels
-                            for nm, ix in self.names.items():
-                                ix[token] = names[nm]
-                        if stack:
-                            stack[-1][1] = rels
+                    gained, lost = self._update(
+                        nm, ix, tools, component, outside, olds,
+                        [change[i] for change in changes])
+                res.append((gained, lost))
+            if any(gained or lost for gained, lost in res):
+                for token in component:
+                    deltas[token] = res
+
+    def _forget(self, token):
+        # the token's old component may already have been replaced by a
+        # new one with the same representative.
+        rep = self.components.pop(token, None)
+        members = None if rep is None else self.members.get(rep)
+        if members is None or token not in members:
+            return
+        members.remove(token)
+        if len(members) < 2:
+            # the member left is on its own
+            del self.members[rep]
+            for other in members:
+                if self.components.get(other) == rep:
+                    del self.components[other]
+        elif token == rep:
+            # the others are named by their smallest member
+            del self.members[rep]
+            rep = members.minKey()
+            self.members[rep] = members
+            for other in members:
+                self.components[other] = rep
+
+    def _record(self, component):
+        # keep ``components`` and ``members`` up to date with a component.
+        rep = min(component)
+        if len(component) == 1:
+            if rep in self.components:
+                self._forget(rep)
+            return
+        members = self.members.get(rep)
+        if (members is not None and len(members) == len(component) and
+                all(self.components.get(t) == rep for t in component)):
+            return  # no change
+        for token in component:
+            self._forget(token)
+        self.members[rep] = self.catalog.getRelationModuleTools()['TreeSet'](
+            component)
+        for token in component:
+            self.components[token] = rep
+
+    def _getOwn(self, nm, component, tools):
+        if nm is None:
+            return tools['Set'](component)
+        return zc.relation.catalog.multiunion(
+            (self.catalog.getValueTokens(nm, token) for token in component),
+            tools)
+
+    def _recompute(self, nm, ix, tools, component, outside, olds,
+                   force=False):
+        # the component's results from scratch, stored as one new set
+        # for all of the members if they changed, or if ``force``.
+        res = zc.relation.catalog.multiunion(
+            [self._getOwn(nm, component, tools)] +
+            [ix.get(child) for child in outside], tools)
+        gained = []
+        lost = []
+        for old in olds.values():
+            if old is None:
+                gained.append(res)
+            else:
+                gained.append(tools['difference'](res, old))
+                lost.append(tools['difference'](old, res))
+        gained = zc.relation.catalog.multiunion(gained, tools)
+        lost = zc.relation.catalog.multiunion(lost, tools)
+        if (force or gained or lost or len(olds) > 1 or
+                None in olds.values()):
+            res = tools['TreeSet'](res)
+            for token in component:
+                ix[token] = res
+        return gained, lost
+
+    def _update(self, nm, ix, tools, component, outside, olds, changes):
+        # change the component's results in place by what the children
+        # gained and lost.  All of the members share one set.
+        old = next(iter(olds.values()))
+        gained = [t for t in zc.relation.catalog.multiunion(
+            (change[0] for change in changes), tools) if t not in old]
+        lost = []
+        candidates = [t for t in zc.relation.catalog.multiunion(
+            (change[1] for change in changes), tools) if t in old]
+        if candidates:
+            own = self._getOwn(nm, component, tools)
+            sets = [ix.get(child) for child in outside]
+            sets = [s for s in sets if s]
+            lost = [t for t in candidates
+                    if t not in own and not any(t in s for s in sets)]
+        old.update(gained)
+        for t in lost:
+            old.remove(t)
+        return gained, lost
+
+    def _getWatched(self):
+        return self.update.union(self.names.keys())
 
     # listener interface
 
     def relationAdded(self, token, catalog, additions):
-        if token in self.index and not self.update.intersection(additions):
+        if (token in self.index and
+                not self._getWatched().intersection(additions)):
             return  # no changes; don't do work
-        self._index(token)
+        self._index(token, additions=additions)
 
     def relationModified(self, token, catalog, additions, removals):
-        if (token in self.index and not self.update.intersection(additions) and
-                not self.update.intersection(removals)):
+        watched = self._getWatched()
+        if (token in self.index and not watched.intersection(additions) and
+                not watched.intersection(removals)):
             return  # no changes; don't do work
-        self._index(token, removals)
+        self._index(token, additions=additions, removals=removals)
 
     def relationRemoved(self, token, catalog, removals):
-        self._index(token, removals, remove=True)
+        self._index(token, removals=removals, remove=True)
+
+    def relationsAdded(self, changes, catalog):
+        self._indexMany([(token, additions, None, False)
+                         for token, additions in changes])
+
+    def relationsModified(self, changes, catalog):
+        self._indexMany([(token, additions, removals, False)
+                         for token, additions, removals in changes])
+
+    def relationsRemoved(self, changes, catalog):
+        self._indexMany([(token, None, removals, True)
+                         for token, removals in changes])
 
     def sourceCleared(self, catalog):
         if self.catalog is catalog:
@@ -265,9 +630,711 @@ class TransposingTransitiveMembership(persistent.Persistent):
             (ix.get(rel) for rel in rels), tools)
 
 
+@zope.interface.implementer(zc.relation.interfaces.ISearchIndex)
+class TransposingTransitiveDepthMembership(TransposingTransitiveMembership):
+    """for searches using zc.relation.queryfactory.TransposingTransitive
+    with a maxDepth.
+
+    Like TransposingTransitiveMembership, but indexes searches with each
+    maxDepth from 2 to the ``maxDepth`` given to the initialization.  A
+    maxDepth of 1 needs no index, and searches without a maxDepth are left to
+    TransposingTransitiveMembership, which can be used alongside this index.
+
+    The index keeps a layer for each depth, mapping a relation token to the
+    relation tokens found from it within that depth.  Once a token's results
+    stop growing, the deeper layers share the same set.  The named value
+    indexes, if any, are layered the same way.
+
+    When a relation changes, only the relations that can reach it within
+    ``maxDepth`` are reindexed, a layer at a time, so cycles need no special
+    handling.
+    """
+
+    def __init__(self, forward, reverse, names=(), static=(), maxDepth=3):
+        if not isinstance(maxDepth, int) or maxDepth < 2:
+            raise ValueError('maxDepth must be an integer of at least 2')
+        super().__init__(forward, reverse, names, static)
+        self.maxDepth = maxDepth
+
+    def _copyLayers(self, layers, tools):
+        res = BTrees.family32.IO.BTree()
+        copies = {}  # keep deeper layers sharing sets
+        for depth, layer in layers.items():
+            new = res[depth] = zc.relation.catalog.getMapping(tools)()
+            for k, v in layer.items():
+                c = copies.get(id(v))
+                if c is None:
+                    c = copies[id(v)] = copy.copy(v)
+                new[k] = c
+        return res
+
+    def copy(self, catalog):
+        new = self.__class__.__new__(self.__class__)
+        new.names = BTrees.family32.OO.Bucket()
+        for nm, val in self.names.items():
+            if val is not None:
+                val = self._copyLayers(
+                    val, self.catalog.getValueModuleTools(nm))
+            new.names[nm] = val
+        new.forward = self.forward
+        new.reverse = self.reverse
+        new.update = self.update
+        new.factory = self.factory
+        new.maxDepth = self.maxDepth
+        if self.index is not None:
+            new.catalog = catalog
+            new.index = self._copyLayers(
+                self.index, self.catalog.getRelationModuleTools())
+        return new
+
+    def _makeLayers(self, tools):
+        res = BTrees.family32.IO.BTree()
+        for depth in range(2, self.maxDepth + 1):
+            res[depth] = zc.relation.catalog.getMapping(tools)()
+        return res
+
+    def setCatalog(self, catalog):
+        if catalog is None:
+            self.index = self.catalog = None
+            return
+        elif self.catalog is not None:
+            raise ValueError('catalog already set')
+        self.catalog = catalog
+        self.index = self._makeLayers(catalog.getRelationModuleTools())
+        for nm in self.names.keys():
+            self.names[nm] = self._makeLayers(
+                catalog.getValueModuleTools(nm))
+        self._reindex(set(catalog.getRelationTokens()))
+        # name, query_names, static_values, maxDepth, filter, queryFactory
+        res = []
+        for depth in range(2, self.maxDepth + 1):
+            res.append((None, (self.forward,), self.factory.static, depth,
+                        None, self.factory))
+            for nm in self.names:
+                res.append((nm, (self.forward,), self.factory.static, depth,
+                            None, self.factory))
+        return res
+
+    def _index(self, token, additions=None, removals=None, remove=False):
+        self._rebuildAbove(self._getStarts(token, additions, removals),
+                           (token,) if remove else ())
+
+    def _indexMany(self, changes):
+        starts, removed = self._getBatchStarts(changes, self.index[2])
+        if starts:
+            self._rebuildAbove(starts, removed)
+
+    def _rebuildAbove(self, starts, removed):
+        # a relation's results only change if it can reach a changed one
+        # within the maximum depth.
+        tokens = self._getAncestors(starts, self.maxDepth)
+        tokens.difference_update(removed)
+        for token in removed:
+            for layers in (self.index,) + tuple(self.names.values()):
+                for layer in layers.values():
+                    layer.pop(token, None)
+        self._reindex(tokens)
+
+    def _reindex(self, tokens):
+        relTools = self.catalog.getRelationModuleTools()
+        query = BTrees.family32.OO.Bucket(
+            ((self.forward, None),) + self.factory.static)
+        getQueries = self.factory(query, self.catalog)
+        children = {}
+        previous = {}
+        for token in tokens:
+            children[token] = zc.relation.catalog.multiunion(
+                (self.catalog.getRelationTokens(q) for q in
+                 getQueries([token])), relTools)
+            previous[token] = relTools['Set']((token,))
+        previousNames = {}
+        for depth in range(2, self.maxDepth + 1):
+            # each layer is built from the one above it: the relation, its
+            # children, and what its children found within one less depth.
+            above = self.index.get(depth - 1)
+            current = {}
+            currentNames = {}
+            for token in tokens:
+                prev = previous[token]
+                sets = [prev, children[token]]
+                if above is not None:
+                    for child in children[token]:
+                        found = previous.get(child)
+                        if found is None:
+                            found = above.get(child)
+                        sets.append(found)
+                rels = zc.relation.catalog.multiunion(sets, relTools)
+                if len(rels) == len(prev):
+                    rels = prev  # it stopped growing: share the set
+                current[token] = rels = self._store(
+                    self.index[depth], token, rels, relTools)
+                names = currentNames[token] = {}
+                for nm, layers in self.names.items():
+                    tools = self.catalog.getValueModuleTools(nm)
+                    if rels is prev and token in previousNames:
+                        values = previousNames[token][nm]
+                    else:
+                        values = zc.relation.catalog.multiunion(
+                            (self.catalog.getValueTokens(nm, rel)
+                             for rel in rels), tools)
+                    names[nm] = self._store(
+                        layers[depth], token, values, tools)
+            previous = current
+            previousNames = currentNames
+
+    def _store(self, layer, token, res, tools):
+        # only write changed results
+        old = layer.get(token)
+        if (old is not None and len(old) == len(res) and
+                not tools['difference'](res, old)):
+            return old
+        layer[token] = res
+        return res
+
+    # listener interface
+
+    def relationAdded(self, token, catalog, additions):
+        if (token in self.index[2] and
+                not self._getWatched().intersection(additions)):
+            return  # no changes; don't do work
+        self._index(token, additions=additions)
+
+    def relationModified(self, token, catalog, additions, removals):
+        watched = self._getWatched()
+        if (token in self.index[2] and not watched.intersection(additions) and
+                not watched.intersection(removals)):
+            return  # no changes; don't do work
+        self._index(token, additions=additions, removals=removals)
+
+    # end listener interface
+
+    def getResults(self, name, query, maxDepth, filter, queryFactory):
+        rels = self.catalog.getRelationTokens(query)
+        if name is None:
+            tools = self.catalog.getRelationModuleTools()
+            layers = self.index
+        else:
+            tools = self.catalog.getValueModuleTools(name)
+            layers = self.names[name]
+        if rels is None:
+            return tools['Set']()
+        elif not rels:
+            return rels
+        ix = layers[maxDepth]
+        return zc.relation.catalog.multiunion(
+            (ix.get(rel) for rel in rels), tools)
+
+
+@zope.interface.implementer(zc.relation.interfaces.IReachabilitySearchIndex)
+class TransposingTransitiveIntervalMembership(
+        TransposingTransitiveMembership):
+    """for searches using zc.relation.queryfactory.TransposingTransitive
+    over hierarchies that are trees, or nearly so.
+
+    Only indexes one direction.  Only indexes with maxDepth=None.
+    Does not support filters.
+
+    Rather than keeping the results of every relation, the index labels the
+    relations with intervals from a depth-first walk of a spanning forest:
+    the interval of a relation contains the intervals of the relations below
+    it in the forest.  The results of a relation are a range of ``labels``,
+    a BTree of labels to relation tokens, so the index only grows with the
+    number of relations.  Relationships that the forest leaves out, where a
+    relation has more than one parent or is in a cycle, are kept in
+    ``extras`` and followed when searching.  Values of the ``names`` are
+    gathered from the relations found.
+
+    The labels are spaced out, so that a new relation without children can
+    usually be labeled within the interval of a parent.  Other changes
+    relabel the trees of the forest that they touch.
+    """
+
+    gap = 2 ** 24  # between the labels of a walk
+    room = 2 ** 12  # the most given to a new relation
+    maxLabel = 2 ** 62
+
+    labels = ends = roots = extras = None
+
+    def copy(self, catalog):
+        new = self.__class__.__new__(self.__class__)
+        new.names = BTrees.family32.OO.Bucket(self.names.items())
+        new.forward = self.forward
+        new.reverse = self.reverse
+        new.update = self.update
+        new.factory = self.factory
+        if self.index is not None:
+            new.catalog = catalog
+            new.index = zc.relation.catalog.getMapping(
+                self.catalog.getRelationModuleTools())(self.index)
+            new.labels = BTrees.family64.IO.BTree(self.labels)
+            new.ends = BTrees.family64.IO.BTree(self.ends)
+            new.roots = BTrees.family64.IO.BTree(self.roots)
+            new.extras = BTrees.family64.IO.BTree(
+                [(k, copy.copy(v)) for k, v in self.extras.items()])
+        return new
+
+    def setCatalog(self, catalog):
+        if catalog is None:
+            self.index = self.catalog = None
+            self.labels = self.ends = self.roots = self.extras = None
+            return
+        return super().setCatalog(catalog)
+
+    def _build(self):
+        self.index = zc.relation.catalog.getMapping(
+            self.catalog.getRelationModuleTools())()
+        self.labels = BTrees.family64.IO.BTree()  # start: token
+        self.ends = BTrees.family64.IO.BTree()  # end: token
+        self.roots = BTrees.family64.IO.BTree()  # start: token
+        self.extras = BTrees.family64.IO.BTree()  # start: TreeSet of tokens
+        self._label(set(self.catalog.getRelationTokens()), 0)
+
+    def _store(self, token, start, end):
+        self.index[token] = (start, end)
+        self.labels[start] = token
+        self.ends[end] = token
+
+    def _link(self, token, child):
+        # keep a relationship that is not in the forest, unless the child is
+        # already below the token.
+        start, end = self.index[token]
+        if start < self.index[child][0] <= end:
+            return
+        children = self.extras.get(start)
+        if children is None:
+            children = self.extras[start] = (
+                self.catalog.getRelationModuleTools()['TreeSet']())
+        children.insert(child)
+
+    def _label(self, region, start):
+        # label the ``region``, which is made of whole trees of the forest,
+        # from ``start``.  Relations without parents in the region start the
+        # trees, then the relations left, which are in cycles.
+        children = self._getRegionChildren(region)
+        inner = set()
+        for token, found in children.items():
+            inner.update(c for c in found if c != token and c in region)
+        starts = {}
+        links = []
+        for root in sorted(region - inner) + sorted(inner):
+            if root not in starts:
+                self.roots[start] = root
+                start = self._walk(
+                    root, region, children, start, self.gap, starts, links)
+        for token, child in links:
+            self._link(token, child)
+
+    def _getRegionChildren(self, region):
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.forward)
+        return {token: self._getChildren(token, getQueries, relTools)
+                for token in region}
+
+    def _walk(self, root, region, children, label, step, starts, links):
+        # label the relations of the ``region`` below the ``root`` that are
+        # not in ``starts`` yet, a ``step`` apart, returning the next label.
+        # Relationships left out of the tree are added to ``links``.
+        starts[root] = label
+        label += step
+        stack = [(root, iter(children[root]))]
+        while stack:
+            token, it = stack[-1]
+            for child in it:
+                if child in region and child not in starts:
+                    starts[child] = label
+                    label += step
+                    stack.append((child, iter(children[child])))
+                    break
+                links.append((token, child))
+            else:
+                stack.pop()
+                self._store(token, starts[token], label)
+                label += step
+        return label
+
+    def _unlabel(self, root):
+        # remove the labels of a tree, returning its relations.
+        start, end = self.index[root]
+        tokens = list(self.labels.values(start, end))
+        for token in tokens:
+            del self.index[token]
+        for ix in (self.labels, self.ends, self.extras):
+            for k in list(ix.keys(start, end)):
+                del ix[k]
+        del self.roots[start]
+        return tokens
+
+    def _getRoot(self, token):
+        return self.roots[self.roots.maxKey(self.index[token][0])]
+
+    def _getNext(self):
+        if not self.ends:
+            return 0
+        return self.ends.maxKey() + self.gap
+
+    def _getFree(self, token):
+        # the free labels below a relation, after its last descendant.
+        start, end = self.index[token]
+        try:
+            used = self.ends.maxKey(end - 1)
+        except ValueError:
+            used = start
+        return max(used, start) + 1, end
+
+    def _relabel(self, tokens, removed=()):
+        # relabel the trees of the ``tokens``, and the ``tokens`` themselves
+        # if they are new, without the ``removed`` relations.
+        region = set()
+        for root in {self._getRoot(t) for t in tokens if t in self.index}:
+            region.update(self._unlabel(root))
+        region.update(tokens)
+        region.difference_update(removed)
+        start = self._getNext()
+        if start + 2 * len(region) * self.gap > self.maxLabel:
+            self._build()  # out of labels: start again from 0
+        else:
+            self._label(region, start)
+
+    def _attach(self, parent, child):
+        # a new relationship.  If the child starts a tree that fits in the
+        # free labels of the parent, the tree is moved there.  Otherwise the
+        # relationship is an extra one.
+        start, end = self.index[child]
+        if (self.roots.get(start) == child and
+                not start <= self.index[parent][0] <= end):
+            used, free = self._getFree(parent)
+            size = len(self.labels.keys(start, end))
+            step = min((free - used) // 2 // (2 * size), self.gap)
+            if step >= 1:
+                region = self._unlabel(child)
+                children = self._getRegionChildren(region)
+                links = []
+                self._walk(child, region, children, used, step, {}, links)
+                for token, other in links:
+                    self._link(token, other)
+                return
+        self._link(parent, child)
+
+    def _index(self, token, additions=None, removals=None, remove=False):
+        if remove or removals and self.update.intersection(removals):
+            tokens = self._getStarts(token, additions, removals)
+            if remove:
+                self._relabel(tokens, (token,))
+            else:
+                query, getQueries = self._getQueries(self.forward)
+                tokens.update(self._getChildren(
+                    token, getQueries,
+                    self.catalog.getRelationModuleTools()))
+                self._relabel(tokens)
+            return
+        # the relation is new, or has only gained relationships, which are
+        # added without relabeling, if there is room.
+        parents = sorted(self._getStarts(token, additions, None) - {token})
+        children = self._getGained(token, additions)
+        if token not in self.index:
+            if parents:
+                used, free = self._getFree(parents[0])
+                room = min((free - used) // 2, self.room)
+                if room < 1:
+                    self._relabel({token}.union(parents, children))
+                    return
+                self._store(token, used, used + room)
+                parents = parents[1:]
+            else:
+                start = self._getNext()
+                if start + self.gap > self.maxLabel:
+                    self._build()
+                    return
+                self.roots[start] = token
+                self._store(token, start, start + self.gap)
+        for parent in parents:
+            self._attach(parent, token)
+        for child in children:
+            self._attach(token, child)
+
+    def _indexMany(self, changes):
+        # the trees of a batch are relabeled together.
+        starts, removed = self._getBatchStarts(changes, self.index)
+        if not starts:
+            return
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.forward)
+        for token, additions, removals, remove in changes:
+            if token in starts and token not in removed:
+                starts.update(self._getChildren(token, getQueries, relTools))
+        self._relabel(starts, removed)
+
+    def _getWatched(self):
+        return self.update
+
+    def _getRanges(self, rels):
+        # the ranges of labels found from the relations: start: end
+        ranges = BTrees.family64.II.BTree()
+        queue = list(rels)
+        while queue:
+            start, end = self.index[queue.pop()]
+            try:
+                k = ranges.maxKey(start)
+            except ValueError:
+                pass
+            else:
+                if ranges[k] >= start:
+                    continue  # already found
+            for k in list(ranges.keys(start, end)):
+                del ranges[k]
+            ranges[start] = end
+            for children in self.extras.values(start, end):
+                queue.extend(children)
+        return ranges
+
+    def canFind(self, query, targetQuery, maxDepth, filter, queryFactory):
+        rels = self.catalog.getRelationTokens(query)
+        targets = self.catalog.getRelationTokens(targetQuery)
+        if not rels or not targets:
+            return False
+        ranges = self._getRanges(rels)
+        for target in targets:
+            start = self.index[target][0]
+            try:
+                k = ranges.maxKey(start)
+            except ValueError:
+                continue
+            if ranges[k] >= start:
+                return True
+        return False
+
+    def getResults(self, name, query, maxDepth, filter, queryFactory):
+        rels = self.catalog.getRelationTokens(query)
+        relTools = self.catalog.getRelationModuleTools()
+        if name is None:
+            tools = relTools
+        else:
+            tools = self.catalog.getValueModuleTools(name)
+        if rels is None:
+            return tools['Set']()
+        elif not rels:
+            return rels
+        res = zc.relation.catalog.multiunion(
+            (relTools['Set'](self.labels.values(start, end))
+             for start, end in self._getRanges(rels).items()), relTools)
+        if name is None:
+            return res
+        return zc.relation.catalog.multiunion(
+            (self.catalog.getValueTokens(name, token) for token in res),
+            tools)
+
+
+def _contains(label, other):
+    # whether the intervals of the ``label`` contain those of ``other``
+    return all(label[i] <= other[i] and other[i + 1] <= label[i + 1]
+               for i in range(0, len(label), 2))
+
+
+def _hull(label, other):
+    # the intervals containing the intervals of both labels
+    return tuple(min(label[i], other[i]) if i % 2 == 0 else
+                 max(label[i], other[i]) for i in range(len(label)))
+
+
+@zope.interface.implementer(zc.relation.interfaces.IReachabilitySearchIndex)
+class TransposingTransitiveReachability(TransposingTransitiveMembership):
+    """answers ``canFind`` with a ``targetQuery`` for searches using
+    zc.relation.queryfactory.TransposingTransitive, over any graph.
+
+    Only indexes one direction.  Only indexes with maxDepth=None.
+    Does not support filters.  Does not answer other searches.
+
+    The index labels each relation with an interval for each of a few
+    randomized depth-first walks (``walks``): the rank of the relation's
+    strongly connected component in the walk's post-order, and the lowest
+    rank found below it.  If a relation can reach another, its intervals
+    contain the other's.  Most relations that cannot reach another fail
+    that test, so a negative answer is usually found at once.  Otherwise the
+    search only walks down through relations whose intervals contain those of
+    a target.
+
+    Changes widen the intervals as needed, so they stay correct but become
+    less selective.  The index labels everything again once it has seen as
+    many changes as there are relations.
+    """
+
+    rank = changes = 0
+
+    def __init__(self, forward, reverse, static=(), walks=3, seed=0):
+        if not isinstance(walks, int) or walks < 1:
+            raise ValueError('walks must be a positive integer')
+        super().__init__(forward, reverse, (), static)
+        self.walks = walks
+        self.seed = seed
+
+    def copy(self, catalog):
+        new = self.__class__.__new__(self.__class__)
+        new.names = BTrees.family32.OO.Bucket()
+        new.forward = self.forward
+        new.reverse = self.reverse
+        new.update = self.update
+        new.factory = self.factory
+        new.walks = self.walks
+        new.seed = self.seed
+        if self.index is not None:
+            new.catalog = catalog
+            new.index = zc.relation.catalog.getMapping(
+                self.catalog.getRelationModuleTools())(self.index)
+            new.rank = self.rank
+            new.changes = self.changes
+        return new
+
+    def setCatalog(self, catalog):
+        if catalog is None:
+            self.index = self.catalog = None
+            return
+        elif self.catalog is not None:
+            raise ValueError('catalog already set')
+        self.catalog = catalog
+        self._build()
+        # name, query_names, static_values, maxDepth, filter, queryFactory
+        return [(None, (self.forward,), self.factory.static, None, None,
+                 self.factory)]
+
+    def _build(self):
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.forward)
+        children = {
+            token: list(self._getChildren(token, getQueries, relTools))
+            for token in self.catalog.getRelationTokens()}
+        labels = {token: [] for token in children}
+        rand = random.Random(self.seed)
+        for walk in range(self.walks):
+            tokens = list(children)
+            rand.shuffle(tokens)
+            for found in children.values():
+                rand.shuffle(found)
+            low = {}
+            # components are found after everything below them
+            for rank, component in enumerate(
+                    _components(tokens, children.__getitem__)):
+                lowest = rank
+                for token in component:
+                    for child in children[token]:
+                        lowest = min(lowest, low.get(child, rank))
+                for token in component:
+                    low[token] = lowest
+                    labels[token].extend((lowest, rank))
+        self.index = zc.relation.catalog.getMapping(relTools)()
+        for token, label in labels.items():
+            self.index[token] = tuple(label)
+        self.rank = len(labels)
+        self.changes = 0
+
+    def _index(self, token, additions=None, removals=None, remove=False):
+        self.changes += 1
+        if self.changes > len(self.catalog):
+            self._build()
+        elif remove:
+            # what is left can still reach less than the labels say
+            self.index.pop(token, None)
+        else:
+            label = self.index.get(token)
+            if label is None:
+                label = (self.rank, self.rank) * self.walks
+                self.rank += 1
+                query, getQueries = self._getQueries(self.forward)
+                children = self._getChildren(
+                    token, getQueries, self.catalog.getRelationModuleTools())
+            else:
+                children = self._getGained(token, additions)
+            for child in children:
+                other = self.index.get(child)
+                if child != token and other is not None:
+                    label = _hull(label, other)
+            self._widen(token, label)
+
+    def _indexMany(self, changes):
+        self.changes += len(changes)
+        if self.changes > len(self.catalog):
+            self._build()
+            return
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.forward)
+        found = {}
+        # new relations are labeled first, so that they can be found
+        # from the others.
+        for token, additions, removals, remove in changes:
+            if remove:
+                self.index.pop(token, None)
+            elif token not in self.index:
+                self.index[token] = (self.rank, self.rank) * self.walks
+                self.rank += 1
+                found[token] = self._getChildren(token, getQueries, relTools)
+            elif additions:
+                found[token] = self._getGained(token, additions)
+        for token, children in found.items():
+            label = self.index[token]
+            for child in children:
+                other = self.index.get(child)
+                if child != token and other is not None:
+                    label = _hull(label, other)
+            self._widen(token, label)
+
+    def _widen(self, token, label):
+        # label the relation, and widen the intervals of the relations above
+        # it until they contain the intervals of the relations below them.
+        self.index[token] = label
+        relTools = self.catalog.getRelationModuleTools()
+        query, getQueries = self._getQueries(self.reverse)
+        queue = collections.deque((token,))
+        while queue:
+            token = queue.popleft()
+            label = self.index[token]
+            for parent in self._getChildren(token, getQueries, relTools):
+                old = self.index.get(parent)
+                if old is not None and not _contains(old, label):
+                    self.index[parent] = _hull(old, label)
+                    queue.append(parent)
+
+    def _getWatched(self):
+        return self.update
+
+    def canFind(self, query, targetQuery, maxDepth, filter, queryFactory):
+        rels = self.catalog.getRelationTokens(query)
+        targets = self.catalog.getRelationTokens(targetQuery)
+        if not rels or not targets:
+            return False
+        relTools = self.catalog.getRelationModuleTools()
+        if relTools['intersection'](rels, targets):
+            return True
+        labels = [self.index[rel] for rel in rels]
+        # only the targets that the relations may reach
+        targetLabels = [
+            label for label in (self.index[target] for target in targets)
+            if any(_contains(other, label) for other in labels)]
+        if not targetLabels:
+            return False
+        stack = [rel for rel, label in zip(rels, labels)
+                 if any(_contains(label, other) for other in targetLabels)]
+        seen = set(stack)
+        query, getQueries = self._getQueries(self.forward)
+        while stack:
+            for child in self._getChildren(stack.pop(), getQueries,
+                                           relTools):
+                if child in seen:
+                    continue
+                if child in targets:
+                    return True
+                seen.add(child)
+                label = self.index[child]
+                if any(_contains(label, other) for other in targetLabels):
+                    stack.append(child)
+        return False
+
+    def getResults(self, name, query, maxDepth, filter, queryFactory):
+        return None  # only answers ``canFind``
+
+
 @zope.interface.implementer(
     zc.relation.interfaces.ISearchIndex,
     zc.relation.interfaces.IListener,
+    zc.relation.interfaces.IBatchMessageListener,
 )
 class Intransitive(persistent.Persistent):
     """saves results for precise search.
@@ -337,8 +1404,35 @@ class Intransitive(persistent.Persistent):
     def relationRemoved(self, token, catalog, removals):
         self._index(token, catalog, removals=removals, removed=True)
 
+    def relationsAdded(self, changes, catalog):
+        self._indexMany(catalog, [(token, additions, None, False)
+                                  for token, additions in changes])
+
+    def relationsModified(self, changes, catalog):
+        self._indexMany(catalog, [(token, additions, removals, False)
+                                  for token, additions, removals in changes])
+
+    def relationsRemoved(self, changes, catalog):
+        self._indexMany(catalog, [(token, None, removals, True)
+                                  for token, removals in changes])
+
     def _index(self, token, catalog, additions=None, removals=None,
                removed=False):
+        for query in self._getChangedQueries(token, catalog, additions,
+                                             removals, removed):
+            self._indexQuery(query)
+
+    def _indexMany(self, catalog, changes):
+        # a query shared by many of the changes is only indexed once.
+        queries = {}
+        for token, additions, removals, removed in changes:
+            queries.update(dict.fromkeys(self._getChangedQueries(
+                token, catalog, additions, removals, removed)))
+        for query in queries:
+            self._indexQuery(query)
+
+    def _getChangedQueries(self, token, catalog, additions, removals,
+                           removed):
         if ((not additions or not self.update.intersection(additions)) and
                 (not removals or not self.update.intersection(removals))):
             return
@@ -348,7 +1442,7 @@ class Intransitive(persistent.Persistent):
             removals = {}
         for query in self.getQueries(token, catalog, additions, removals,
                                      removed):
-            self._indexQuery(tuple(query.items()))
+            yield tuple(query.items())
 
     def _indexQuery(self, query):
         dquery = dict(query)
@@ -472,3 +1566,199 @@ class Intransitive(persistent.Persistent):
             else:
                 res = self.catalog.getValueModuleTools(self.name)['Set']()
         return res
+
+
+def _freeze(changes):
+    # a copy of the additions or removals of a message to keep.
+    if not changes:
+        return None
+    return {name: None if tokens is None else tuple(tokens)
+            for name, tokens in changes.items()}
+
+
+class Queue(persistent.Persistent):
+    """a persistent queue of (key, value) pairs, in the order of their keys,
+    which are unique positive 64 bit integers.
+
+    The pairs are kept in a BTree, so adding and taking pairs only changes
+    the buckets that hold them, and the BTree resolves the conflicts of
+    transactions that change different pairs of the same bucket.  The BTree
+    cannot resolve them if a transaction empties the bucket, so the queue
+    keeps a pair of its own under the key 0: taking all of a small queue
+    does not conflict with adding to it.
+    """
+
+    def __init__(self, items=()):
+        self._data = BTrees.family64.IO.BTree()
+        self._data[0] = None
+        self._data.update(items)
+
+    def __len__(self):
+        return len(self._data) - 1
+
+    def __iter__(self):
+        return iter(self._data.items(1))
+
+    def get(self, key):
+        """the value of the key, or None."""
+        return self._data.get(key)
+
+    def lastKey(self):
+        """the largest key, or 0 if the queue is empty."""
+        return self._data.maxKey()
+
+    def append(self, key, value):
+        """add the pair, and return True; or False if the key is taken."""
+        return bool(self._data.insert(key, value))
+
+    def pull(self, size=None):
+        """remove and return the ``size`` first pairs, or all of them."""
+        res = list(itertools.islice(self._data.items(1), size))
+        for key, value in res:
+            del self._data[key]
+        return res
+
+    def clear(self):
+        self._data.clear()
+        self._data[0] = None
+
+
+@zope.interface.implementer(zc.relation.interfaces.ISearchIndex,
+                            zc.relation.interfaces.IBatchMessageListener)
+class Queued(persistent.Persistent):
+    """maintains another search index in the background.
+
+    The messages from the catalog are only added to a persistent queue, so
+    writes stay cheap.  A worker, usually in another process, calls
+    ``process`` to send the queued changes to the index in a batch.  Until
+    then, the results of the index may be stale; ``getLag`` reports by how
+    long, and ``length`` counts the queued changes.  If ``stale`` is False,
+    the index does not answer while changes are queued, so the catalog
+    searches without it.  Searches can also pass ``ignoreSearchIndex``.
+
+    The ``queue`` holds the changes of each transaction, keyed by the time
+    in milliseconds when the first was queued, and a random number, after
+    the keys already queued.  It resolves the conflicts between the
+    transactions that add to it and a worker that processes it, a bucket at
+    a time.
+    """
+
+    catalog = None
+    _v_block = None  # (transaction, key, the changes of the transaction)
+
+    def __init__(self, index, stale=True):
+        self.index = index
+        self.stale = stale
+        self.queue = Queue()
+        self.length = BTrees.Length.Length()
+
+    def copy(self, catalog):
+        res = self.__class__.__new__(self.__class__)
+        res.catalog = catalog
+        res.index = self.index.copy(catalog)
+        res.stale = self.stale
+        res.queue = Queue(
+            (key, persistent.list.PersistentList(block))
+            for key, block in self.queue)
+        res.length = BTrees.Length.Length(self.length.value)
+        return res
+
+    def setCatalog(self, catalog):
+        self.catalog = catalog
+        self.queue.clear()
+        self.length.set(0)
+        self._v_block = None
+        return self.index.setCatalog(catalog)
+
+    def _enqueue(self, changes):
+        if not changes:
+            return
+        txn = zc.relation.catalog.getTransaction(self.catalog)
+        block = None
+        if self._v_block is not None and self._v_block[0] is txn:
+            key, block = self._v_block[1:]
+            if self.queue.get(key) is not block:
+                block = None  # rolled back to a savepoint before it
+        if block is None:
+            block = persistent.list.PersistentList()
+            key = None
+            while key is None or not self.queue.append(key, block):
+                # after the blocks already queued, even of the same
+                # millisecond, so that they are processed in order
+                key = (max(int(time.time() * 1000) << 20,
+                           self.queue.lastKey() + 1) |
+                       random.randrange(1 << 20))
+            self._v_block = (txn, key, block)
+        block.extend(changes)
+        self.length.change(len(changes))
+
+    def process(self, size=None):
+        """send the queued changes of the ``size`` oldest transactions, or
+        of all of them, to the index.  Returns the number of changes."""
+        # the catalog may already have the changes of later transactions,
+        # so the index may have found relations that it has not been told
+        # about yet.
+        changes = zc.relation.catalog.Changes(forgetAdded=False)
+        count = 0
+        for key, block in self.queue.pull(size):
+            for kind, token, additions, removals in block:
+                changes.add(kind, token, additions, removals)
+            count += len(block)
+        self._v_block = None  # later changes go to a new block
+        if count:
+            self.length.change(-count)
+            changes.send(self.catalog, [self.index])
+        return count
+
+    def getLag(self):
+        """the seconds since the oldest queued change, or 0."""
+        for key, block in self.queue:
+            break
+        else:
+            return 0.0
+        return max(0.0, time.time() - (key >> 20) / 1000.0)
+
+    # listener interface
+
+    def relationAdded(self, token, catalog, additions):
+        self._enqueue([(zc.relation.catalog.ADDED, token,
+                        _freeze(additions), None)])
+
+    def relationModified(self, token, catalog, additions, removals):
+        if additions or removals:
+            self._enqueue([(zc.relation.catalog.MODIFIED, token,
+                            _freeze(additions), _freeze(removals))])
+
+    def relationRemoved(self, token, catalog, removals):
+        self._enqueue([(zc.relation.catalog.REMOVED, token, None,
+                        _freeze(removals))])
+
+    def relationsAdded(self, changes, catalog):
+        self._enqueue([(zc.relation.catalog.ADDED, token,
+                        _freeze(additions), None)
+                       for token, additions in changes])
+
+    def relationsModified(self, changes, catalog):
+        self._enqueue([(zc.relation.catalog.MODIFIED, token,
+                        _freeze(additions), _freeze(removals))
+                       for token, additions, removals in changes
+                       if additions or removals])
+
+    def relationsRemoved(self, changes, catalog):
+        self._enqueue([(zc.relation.catalog.REMOVED, token, None,
+                        _freeze(removals))
+                       for token, removals in changes])
+
+    def sourceCleared(self, catalog):
+        self.queue.clear()
+        self.length.set(0)
+        self._v_block = None
+        self.index.sourceCleared(catalog)
+
+    # end listener interface
+
+    def getResults(self, name, query, maxDepth, filter, queryFactory):
+        if not self.stale and self.length.value:
+            return None  # search without the index
+        return self.index.getResults(
+            name, query, maxDepth, filter, queryFactory)
@@ -54,5 +54,15 @@ def test_suite():
             setUp=setUp,
             tearDown=tearDown,
         ),
+        doctest.DocFileSuite(
+            'bitmap.rst',
+            setUp=setUp,
+            tearDown=tearDown,
+        ),
+        doctest.DocFileSuite(
+            'transient.rst',
+            setUp=setUp,
+            tearDown=tearDown,
+        ),
     ))
     return res
@@ -0,0 +1,68 @@
+"""
+Measure when a catalog should remove tokens from a value index's token set,
+rather than build a new set, for a BTrees module on this machine; and
+optionally store the resulting policy in a catalog in a FileStorage.
+
+Usage:
+
+    python recycle_policy.py [--btree BTrees.family64.IF]
+                             [--storage Data.fs --name catalog]
+
+Example output:
+
+----8<----8<----8<----
+
+zc.relation.catalog.RecyclePolicy(minRemovals=4, ratio=0.19, largeSize=500,
+largeRatio=0.21)
+
+----8<----8<----8<----
+
+The set_creation_vs_removal.py measurements led to the default policy,
+RecyclePolicy(minRemovals=5, ratio=0.1, largeSize=500, largeRatio=0.2).
+A policy for the btree of only one value index can be given to
+``addValueIndex`` as its ``recyclePolicy``.
+"""
+
+import argparse
+import importlib
+
+import zc.relation.catalog
+
+
+def getModule(name):
+    # "BTrees.family64.IF" or "BTrees.LFBTree"
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        module, attr = name.rsplit('.', 1)
+        return getattr(getModule(module), attr)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--btree', default='BTrees.family32.IF',
+        help='the BTrees module of the value index tokens')
+    parser.add_argument(
+        '--storage', help='a FileStorage with a catalog to store the policy')
+    parser.add_argument(
+        '--name', default='catalog',
+        help='the key of the catalog in the database root')
+    options = parser.parse_args(args)
+    policy = zc.relation.catalog.calibrateRecyclePolicy(
+        getModule(options.btree))
+    print(policy)
+    if options.storage:
+        import transaction
+        import ZODB.FileStorage
+        db = ZODB.DB(ZODB.FileStorage.FileStorage(options.storage))
+        try:
+            conn = db.open()
+            conn.root()[options.name].recyclePolicy = policy
+            transaction.commit()
+        finally:
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
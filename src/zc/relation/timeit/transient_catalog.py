@@ -0,0 +1,142 @@
+"""
+Compare the indexing and query throughput of a TransientCatalog with that of
+a catalog of BTrees.
+
+Usage:
+
+    python transient_catalog.py [--relations 20000] [--queries 20000]
+
+Example output:
+
+----8<----8<----8<----
+
+20000 relations, 20000 queries
+                                BTrees   transient
+index (relations/s)               7488       11925
+indexMany (relations/s)           8077       10974
+reindex (relations/s)             9058       18326
+intransitive (queries/s)         37945       40849
+two values (queries/s)           14068       29999
+transitive (queries/s)            3421        5930
+
+----8<----8<----8<----
+
+"""
+
+import argparse
+import random
+import time
+
+import BTrees
+
+import zc.relation.catalog
+import zc.relation.queryfactory
+import zc.relation.transient
+
+
+class Relation:
+
+    def __init__(self, id, parts, color):
+        self.id = id
+        self.parts = parts
+        self.color = color
+
+
+def parts(rel, catalog):
+    return rel.parts
+
+
+def color(rel, catalog):
+    return rel.color
+
+
+def token(rel, catalog):
+    return rel.id
+
+
+def makeCatalog(factory, relations):
+    def dump(rel, catalog, cache):
+        return rel.id
+
+    def load(token, catalog, cache):
+        return relations[token]
+    catalog = factory(dump, load)
+    catalog.addValueIndex(parts, multiple=True)
+    catalog.addValueIndex(color)
+    catalog.addValueIndex(token, name='id')
+    catalog.addDefaultQueryFactory(
+        zc.relation.queryfactory.TransposingTransitive('id', 'parts'))
+    return catalog
+
+
+def makeRelations(count, seed):
+    rnd = random.Random(seed)
+    return {i: Relation(i, [rnd.randrange(count) for _ in range(3)],
+                        rnd.randrange(20))
+            for i in range(count)}
+
+
+def rate(count, seconds):
+    return '%11d' % (count / seconds)
+
+
+def measure(factory, options):
+    relations = makeRelations(options.relations, 0)
+    rnd = random.Random(1)
+    res = []
+    catalog = makeCatalog(factory, relations)
+    start = time.perf_counter()
+    for rel in relations.values():
+        catalog.index(rel)
+    res.append(rate(len(relations), time.perf_counter() - start))
+    catalog = makeCatalog(factory, relations)
+    start = time.perf_counter()
+    catalog.indexMany(relations.values())
+    res.append(rate(len(relations), time.perf_counter() - start))
+    for rel in relations.values():
+        rel.color = rnd.randrange(20)
+    start = time.perf_counter()
+    for rel in relations.values():
+        catalog.index(rel)
+    res.append(rate(len(relations), time.perf_counter() - start))
+    tokens = [rnd.randrange(options.relations)
+              for _ in range(options.queries)]
+    start = time.perf_counter()
+    for token in tokens:
+        list(catalog.findRelationTokens({'parts': token}, maxDepth=1))
+    res.append(rate(len(tokens), time.perf_counter() - start))
+    start = time.perf_counter()
+    for token in tokens:
+        list(catalog.findRelationTokens(
+            {'parts': token, 'color': token % 20}, maxDepth=1))
+    res.append(rate(len(tokens), time.perf_counter() - start))
+    tokens = tokens[:len(tokens) // 10]
+    start = time.perf_counter()
+    for token in tokens:
+        list(catalog.findValueTokens('color', {'id': token}, maxDepth=3))
+    res.append(rate(len(tokens), time.perf_counter() - start))
+    return res
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--relations', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=20000)
+    options = parser.parse_args(args)
+
+    def btrees(dump, load):
+        return zc.relation.catalog.Catalog(
+            dump, load, BTrees.family64.IF, BTrees.family64)
+    names = ['index (relations/s)', 'indexMany (relations/s)',
+             'reindex (relations/s)', 'intransitive (queries/s)',
+             'two values (queries/s)', 'transitive (queries/s)']
+    results = zip(names, measure(btrees, options),
+                  measure(zc.relation.transient.TransientCatalog, options))
+    print('%d relations, %d queries' % (options.relations, options.queries))
+    print('%-28s%10s%12s' % ('', 'BTrees', 'transient'))
+    for name, btree, transient in results:
+        print('%-28s%s %s' % (name, btree, transient))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+##############################################################################
+#
+# Copyright (c) 2006-2008 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A catalog in plain dicts and sets, for use within one process.
+
+The module has the Set, TreeSet, union, intersection, difference and
+multiunion of a BTrees module, so it can also be the ``btree`` of a catalog
+or value index.  See transient.rst.
+"""
+import builtins
+import sys
+import types
+
+from zc.relation import catalog
+
+
+##############################################################################
+# sets
+#
+
+class OSet(set):
+    """a set of tokens with the methods of a BTrees set.
+
+    ``keys``, ``minKey`` and ``maxKey`` are in token order, as for a BTrees
+    set; iterating over the set is not, so that it stays cheap."""
+
+    keyType = 'O'  # any objects, for zc.relation.catalog.getKeyType
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.keys())
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def has_key(self, key):
+        return key in self
+
+    def insert(self, key):
+        if key in self:
+            return 0
+        self.add(key)
+        return 1
+
+    def update(self, items):
+        count = len(self)
+        set.update(self, items)
+        return len(self) - count
+
+    def keys(self, min=None, max=None, excludemin=False, excludemax=False):
+        res = sorted(self)
+        if min is not None:
+            res = [k for k in res
+                   if k > min or k == min and not excludemin]
+        if max is not None:
+            res = [k for k in res
+                   if k < max or k == max and not excludemax]
+        return res
+
+    def minKey(self, min=None):
+        if min is None:
+            keys = self
+        else:
+            keys = [k for k in self if k >= min]
+        if not keys:
+            raise ValueError('empty tree' if min is None else
+                             'no key satisfies the conditions')
+        return builtins.min(keys)
+
+    def maxKey(self, max=None):
+        if max is None:
+            keys = self
+        else:
+            keys = [k for k in self if k <= max]
+        if not keys:
+            raise ValueError('empty tree' if max is None else
+                             'no key satisfies the conditions')
+        return builtins.max(keys)
+
+
+Set = TreeSet = OSet
+
+
+##############################################################################
+# set operations
+#
+# As the functions of BTrees modules, these return Sets; and None stands for
+# the universe of tokens.
+
+def _asSet(s):
+    if isinstance(s, set):
+        return s
+    return OSet(s)
+
+
+def union(c1, c2):
+    if c1 is None:
+        return c2
+    if c2 is None:
+        return c1
+    res = OSet(_asSet(c1))
+    set.update(res, _asSet(c2))
+    return res
+
+
+def intersection(c1, c2):
+    if c1 is None:
+        return c2
+    if c2 is None:
+        return c1
+    return OSet(set.intersection(_asSet(c1), _asSet(c2)))
+
+
+def difference(c1, c2):
+    if c1 is None or c2 is None:
+        return c1
+    return OSet(set.difference(_asSet(c1), _asSet(c2)))
+
+
+def multiunion(seq):
+    res = OSet()
+    for s in seq:
+        if isinstance(s, int):
+            res.add(s)
+        else:
+            set.update(res, _asSet(s))
+    return res
+
+
+##############################################################################
+# the catalog
+#
+
+class Bucket(dict):
+    """a dict whose keys are in order, as those of a BTrees bucket are.
+
+    The catalog keeps its value indexes in one, and fingerprints need them
+    in the order of their names.  It is for the few keys of such mappings:
+    a key set out of order rebuilds it."""
+
+    def __init__(self, items=()):
+        dict.__init__(self, sorted(dict(items).items()))
+
+    def __setitem__(self, key, value):
+        if key in self or not self or key > next(reversed(self)):
+            dict.__setitem__(self, key, value)
+        else:
+            items = sorted(list(self.items()) + [(key, value)])
+            self.clear()
+            dict.update(self, items)
+
+
+# what the catalog uses of a BTrees family
+family = types.SimpleNamespace(
+    OO=types.SimpleNamespace(BTree=dict, Bucket=Bucket),
+    IF=sys.modules[__name__])
+
+
+class TransientCatalog(catalog.Catalog):
+    """a catalog that keeps its tokens in dicts and sets.
+
+    It is for catalogs that are built and searched within one process, and
+    that are never stored in a database.  Relations and values are in this
+    module's sets unless the catalog, or a value index, has another btree.
+
+    It stays a subclass of the persistent Catalog to share its code; outside
+    a database, persistence does nothing.
+    """
+
+    family = family
+    _Length = catalog.Length
+
+    def __init__(self, dump, load, btree=None):
+        super().__init__(dump, load, btree)
+
+    def _createMapping(self, data):
+        return {}
+
+    def _createForward(self, data):
+        return {}
+
+    def _createFingerprints(self):
+        return {}
+
+    def getValueTokens(self, name, reltoken=None):
+        if reltoken is None:
+            return OSet(self._name_TO_mapping[name])
+        return super().getValueTokens(name, reltoken)